@@ -0,0 +1,674 @@
+import argparse
+import ast
+import concurrent.futures
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import zlib
+from OpenSSL import SSL
+from twisted.internet import defer
+import framing
+import identity
+import pubkeys
+import tlscontext
+import transfer
+
+# Rough numbers for the hot paths, run with `python benchmark.py`
+
+# The old `¬||¬{chunk}` encoding, only kept here to compare against
+def legacy_encode(chunk):
+    return f"¬||¬{chunk}".encode('utf-8')
+
+def legacy_decode(data):
+    return ast.literal_eval(data.decode('utf-8').replace("¬||¬", ""))
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+class FrameSink(framing.FramedProtocol):
+    def __init__(self):
+        self.transport = NullTransport()
+        self.received = 0
+
+    def frame_received(self, frame_type, payload):
+        self.received += len(payload)
+
+# Pulls from a producer as fast as it will go, checksumming the data so every page really gets read
+# the way the TLS layer would when it encrypts it
+class PullConsumer:
+    def __init__(self):
+        self.producer = None
+        self.written = 0
+        self.checksum = 0
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.written += len(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+def mb_per_second(size, elapsed):
+    return size / (1024 * 1024) / elapsed if elapsed else float("inf")
+
+def bench_payload_encoding(size, chunk_size):
+    data = os.urandom(size)
+    chunks = [data[i:i + chunk_size] for i in range(0, size, chunk_size)]
+    results = {}
+
+    wire_bytes = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        wire = legacy_encode(chunk)
+        wire_bytes += len(wire)
+        assert legacy_decode(wire) == chunk
+    elapsed = time.perf_counter() - start
+    results["legacy_literal_eval"] = {"mb_s": mb_per_second(size, elapsed), "wire_bytes": wire_bytes}
+
+    sink = FrameSink()
+    wire_bytes = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        wire = framing.pack(framing.FILE_CHUNK, chunk)
+        wire_bytes += len(wire)
+        sink.dataReceived(wire)
+    elapsed = time.perf_counter() - start
+    assert sink.received == size
+    results["framed_raw"] = {"mb_s": mb_per_second(size, elapsed), "wire_bytes": wire_bytes}
+    return results
+
+def bench_send_backends(size, chunk_size):
+    results = {}
+    with tempfile.NamedTemporaryFile() as f:
+        for _ in range(0, size, 1024 * 1024):
+            f.write(os.urandom(1024 * 1024))
+        f.flush()
+        size = os.path.getsize(f.name)
+        for backend in transfer.SEND_BACKENDS:
+            with open(f.name, "rb") as source:
+                sender = transfer.make_file_sender(backend, source, [[0, size]], chunk_size)
+                consumer = PullConsumer()
+                sender.beginFileTransfer(consumer)
+                cpu_start = time.process_time()
+                start = time.perf_counter()
+                while consumer.producer is not None:
+                    consumer.producer.resumeProducing()
+                elapsed = time.perf_counter() - start
+                cpu = time.process_time() - cpu_start
+                sender.close()
+            results[backend] = {"cpu_s_per_gb": cpu * (1024 ** 3) / size, "mb_s": mb_per_second(size, elapsed)}
+    return results
+
+class CountingTree:
+    def __init__(self):
+        self.deltas = 0
+
+    def sendDelta(self, data):
+        self.deltas += 1
+
+# Registrations arriving `interval` seconds apart on a fake clock, one delta per flush
+def bench_forest_flush(registrations, interval, windows):
+    from twisted.internet import task
+    import ultrapeer
+    results = {}
+    real_reactor = ultrapeer.reactor
+    try:
+        for window in windows:
+            clock = task.Clock()
+            ultrapeer.reactor = clock
+            ultrapeer.forest = ultrapeer.Forest()
+            ultrapeer.forest_factory = factory = ultrapeer.ForestFactory(window)
+            tree = CountingTree()
+            factory.trees.append(tree)
+            for i in range(registrations):
+                factory.queue_change(ultrapeer.forest.set(f"leaf-{i}", {"ip": "10.0.0.1", "port": 5000, "rport": 40000}))
+                clock.advance(interval)
+            clock.advance(window)
+            stats = factory.flush_stats
+            results[f"window_{window}s"] = {
+                "deltas": tree.deltas,
+                "bytes": stats["bytes"],
+                "avg_flush_latency_ms": stats["latency"] / stats["flushes"] * 1000 if stats["flushes"] else 0.0,
+            }
+    finally:
+        ultrapeer.reactor = real_reactor
+    return results
+
+class FakeTransport:
+    pass
+
+# The old disconnect, a scan over a copy of the whole directory looking for the transport
+def legacy_remove_by_transport(forest, transport):
+    for public_key, client_transport in list(forest.transports.items()):
+        if client_transport is transport:
+            forest.remove(public_key)
+            break
+
+# Leaves dropping off an ultrapeer with `leaves` registered, scan vs the transport index
+def bench_forest_disconnects(sizes, disconnects):
+    import ultrapeer
+    results = {}
+    for leaves in sizes:
+        for name, remove in (("scan", legacy_remove_by_transport), ("index", lambda forest, transport: [forest.remove(key) for key in list(forest.by_transport[transport])])):
+            forest = ultrapeer.Forest()
+            transports = [FakeTransport() for _ in range(leaves)]
+            for i, transport in enumerate(transports):
+                forest.set(f"leaf-{i}", {"ip": "10.0.0.1", "port": 5000, "rport": 40000}, transport)
+            # The scan is far too slow to run as many times, a handful is enough to see the per disconnect cost
+            count = min(disconnects, leaves) if name == "index" else min(disconnects, 50)
+            start = time.perf_counter()
+            for transport in transports[-count:]: # Newest last so the scan cannot get lucky early
+                remove(forest, transport)
+            elapsed = time.perf_counter() - start
+            assert len(forest.forest) == leaves - count
+            results[f"{leaves}_leaves_{name}"] = {"disconnects": count, "us_per_disconnect": elapsed / count * 1e6}
+    return results
+
+# Memory the directory holds per leaf, the old dict of PEM text -> details dict against the fingerprint keyed one
+# Keys are random bytes the size of a 2048 bit DER key, written out the way leaves send them
+def bench_forest_memory(leaves):
+    import ultrapeer
+    ders = [os.urandom(294) for _ in range(leaves)]
+    results = {}
+    for name in ("pem_dict", "fingerprint_slots"):
+        tracemalloc.start()
+        start = time.perf_counter()
+        if name == "pem_dict":
+            directory = {}
+            for i, der in enumerate(ders):
+                directory[pubkeys.to_text(der)] = {"ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", "port": str(5000 + i % 5000), "rport": 40000 + i % 20000}
+        else:
+            directory = ultrapeer.Forest()
+            for i, der in enumerate(ders):
+                directory.set(pubkeys.to_text(der), {"ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", "port": str(5000 + i % 5000), "rport": 40000 + i % 20000})
+        elapsed = time.perf_counter() - start
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del directory
+        results[name] = {"leaves": leaves, "bytes_per_leaf": held / leaves, "mb": held / (1024 * 1024), "build_s": elapsed}
+    return results
+
+# What a leaf spends on keys before it can connect to anything, first run against every run after and
+# both keys made one after the other against at the same time like leaf.main does,
+# plus what each `connect` cost when it made a fresh SSLFactory against reusing the shared context
+def bench_leaf_startup(runs, connects):
+    import leaf
+    results = {}
+    with tempfile.TemporaryDirectory() as state_dir:
+        for name in ("cold", "cold_parallel", "warm"):
+            elapsed = 0.0
+            for _ in range(runs):
+                if name.startswith("cold"):
+                    for filename in os.listdir(state_dir):
+                        os.remove(os.path.join(state_dir, filename))
+                store = identity.IdentityStore(state_dir)
+                start = time.perf_counter()
+                if name == "cold_parallel":
+                    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+                        keypair = pool.submit(store.load_identity)
+                        tls_key, tls_cert = store.load_tls()
+                        keypair.result()
+                else:
+                    _, tls_key, tls_cert = store.load()
+                leaf.SSLFactory(tls_key, tls_cert).getContext()
+                elapsed += time.perf_counter() - start
+            results[f"startup_{name}"] = {"runs": runs, "ms": elapsed / runs * 1000}
+        shared = leaf.SSLFactory(tls_key, tls_cert)
+        for name in ("new_factory", "shared_context"):
+            start = time.perf_counter()
+            for _ in range(connects):
+                (leaf.SSLFactory() if name == "new_factory" else shared).getContext()
+            results[f"connect_{name}"] = {"connects": connects, "ms": (time.perf_counter() - start) / connects * 1000}
+    return results
+
+def handshake(client, server):
+    client.set_connect_state()
+    server.set_accept_state()
+    for _ in range(20):
+        for connection in (client, server):
+            try:
+                connection.do_handshake()
+            except SSL.WantReadError:
+                pass
+        for source, destination in ((client, server), (server, client)):
+            try:
+                destination.bio_write(source.bio_read(65536))
+            except SSL.WantReadError:
+                pass
+    # Push a record through so the TLS 1.3 ticket reaches the client
+    server.send(b"x")
+    client.bio_write(server.bio_read(65536))
+    client.recv(1)
+    # OpenSSL will not resume a session from a connection that was never closed properly
+    client.shutdown()
+
+def bench_tls_handshakes(handshakes):
+    tls_key, tls_cert = identity.make_self_signed()
+    server = tlscontext.SharedContextFactory(tls_key, tls_cert)
+    results = {}
+    for name in ("full", "resumed"):
+        client = tlscontext.SharedContextFactory(tls_key, tls_cert)
+        start, cpu = time.perf_counter(), time.process_time()
+        for i in range(handshakes):
+            # A new server every time means there is never a session to resume
+            handshake(client.client_connection(("bench", i if name == "full" else 0)), server.serverConnectionForTLS(None))
+        results[name] = {"handshakes": handshakes, "ms": (time.perf_counter() - start) / handshakes * 1000,
+                         "cpu_ms": (time.process_time() - cpu) / handshakes * 1000, "resumed": client.handshake_stats.resumed}
+    return results
+
+# Offers from peers get taken straight away, HELLOs go unanswered as the senders do not wait for them
+class AcceptFiles:
+    def ask(self, kind, owner, prompt):
+        return defer.succeed(True if kind == "file" else None)
+
+    def drop(self, owner):
+        pass
+
+def make_leaf(leaf):
+    from Crypto.PublicKey import RSA
+    leaf.program_state = leaf.State()
+    leaf.program_state.compression = False # Random data, compressing it would only measure the codec
+    leaf.decisions = AcceptFiles()
+    leaf.peer_pool = leaf.PeerPool()
+    leaf.contacts = leaf.Contacts()
+    leaf.keypair = RSA.generate(1024)
+    leaf.ssl_factory = leaf.SSLFactory(*identity.make_self_signed())
+
+# A peer in its own process, like it would be on another machine. Offers `source` once everyone is ready
+def peer_sender(port, source, cwd, ready):
+    from twisted.internet import reactor
+    os.chdir(cwd) # The leaf logs under ./logs
+    import leaf
+    make_leaf(leaf)
+
+    class Sender(leaf.CommunicationProtocol):
+        def connectionMade(self):
+            super().connectionMade()
+            self.offer_file(source, 1)
+
+        def file_sent(self, outgoing):
+            super().file_sent(outgoing)
+            reactor.callLater(1, reactor.stop)
+    factory = leaf.CommunicationClientFactory(b"")
+    factory.protocol = Sender
+    ready.wait()
+    reactor.connectSSL("127.0.0.1", port, factory, leaf.ssl_factory)
+    reactor.run()
+
+# One leaf receiving a file from each of `peers` sender processes at once over loopback TLS, for every count in peer_counts
+def bench_peer_throughput(size, peer_counts):
+    import multiprocessing
+    from twisted.internet import reactor, task, threads
+    import leaf
+    make_leaf(leaf)
+    results = {}
+    cwd = os.getcwd()
+    context = multiprocessing.get_context("spawn") # Each sender gets a fresh reactor
+    listener = reactor.listenSSL(0, leaf.CommunicationClientFactory(leaf.keypair.public_key().export_key()), leaf.ssl_factory, interface="127.0.0.1")
+    port = listener.getHost().port
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.bin")
+        with open(source, "wb") as f:
+            f.write(os.urandom(size))
+        received = os.path.join(directory, "received")
+        os.mkdir(received)
+
+        def run(counts):
+            if not counts:
+                reactor.stop()
+                return
+            peers = counts[0]
+            for filename in os.listdir(received):
+                os.remove(os.path.join(received, filename))
+            ready = context.Barrier(peers + 1)
+            senders = [context.Process(target=peer_sender, args=(port, source, cwd, ready)) for _ in range(peers)]
+            for sender in senders:
+                sender.start()
+            threads.deferToThread(ready.wait).addCallback(lambda _: started(counts, senders))
+
+        # Two peers sending source.bin at once get source.bin and source (1).bin, done once all are in place
+        def started(counts, senders):
+            peers = counts[0]
+            start = time.perf_counter()
+
+            def check():
+                if sum(1 for filename in os.listdir(received) if filename.endswith(".bin")) < peers:
+                    return
+                loop.stop()
+                elapsed = time.perf_counter() - start
+                results[f"peers_{peers}"] = {"mb": peers * size // (1024 * 1024), "seconds": elapsed, "aggregate_mb_s": mb_per_second(peers * size, elapsed)}
+                threads.deferToThread(lambda: [sender.join() for sender in senders]).addCallback(lambda _: run(counts[1:]))
+            loop = task.LoopingCall(check)
+            loop.start(0.01)
+
+        os.chdir(received) # Files land wherever the leaf runs
+        try:
+            reactor.callWhenRunning(run, list(peer_counts))
+            reactor.run()
+        finally:
+            os.chdir(cwd)
+    return results
+
+# A leaf that registers `count` times, a new TLS connection each time like a leaf starting up
+def register_leaves(port, count, name, ready):
+    import socket
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    ready.wait()
+    for i in range(count):
+        with context.wrap_socket(socket.create_connection(("127.0.0.1", port))) as connection:
+            connection.sendall(framing.pack(framing.REGISTRATION, f"{name}-{i}¬|¬9999".encode('utf-8')))
+            connection.recv(65536) # "You are at ..." once it is in the forest
+
+def wait_for_port(port, timeout=30):
+    import socket
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def start_ultrapeer(port, fport, workers=1):
+    import multiprocessing
+    import ultrapeer
+    server = multiprocessing.get_context("spawn").Process(target=ultrapeer.main,
+        args=("127.0.0.1", 4443, False, port, fport, "", 0.05, True, workers))
+    server.start()
+    wait_for_port(port)
+    return server
+
+def stop_ultrapeer(server):
+    server.terminate()
+    server.join()
+
+# Runs `target(*args, results)` in a process of its own, so with a fresh reactor, and returns what it put in `results`
+def in_process(target, *args):
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=target, args=(*args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+# Registrations a second, each with a full handshake, against an ultrapeer run with each of worker_counts
+def bench_ultrapeer_workers(registrations, worker_counts, leaves=8, port=19999, fport=19444):
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for workers in worker_counts:
+        server = start_ultrapeer(port, fport, workers)
+        try:
+            ready = context.Barrier(leaves + 1)
+            clients = [context.Process(target=register_leaves, args=(port, registrations // leaves, f"leaf-{workers}-{i}", ready)) for i in range(leaves)]
+            for client in clients:
+                client.start()
+            ready.wait()
+            start = time.perf_counter()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            stop_ultrapeer(server)
+        results[f"workers_{workers}"] = {"registrations": registrations // leaves * leaves, "seconds": elapsed,
+                                         "per_second": registrations // leaves * leaves / elapsed}
+    return results
+
+# A leaf as far as the ultrapeer can tell. It registers as soon as it is connected and stays connected
+# so it can be used to time queries
+class LoadLeaf(framing.FramedProtocol):
+    def __init__(self, name, registered):
+        self.name = name
+        self.registered = registered # Fired with this leaf once the ultrapeer has answered the registration
+        self.answered = None
+
+    def connectionMade(self):
+        self.send_frame(framing.REGISTRATION, f"{self.name}¬|¬9999".encode('utf-8'))
+
+    def connectionLost(self, reason):
+        for d in (self.registered, self.answered):
+            if d is not None:
+                d.errback(reason)
+        self.registered = self.answered = None
+
+    def frame_received(self, frame_type, payload):
+        if self.registered is not None:
+            d, self.registered = self.registered, None
+            d.callback(self)
+        elif self.answered is not None:
+            d, self.answered = self.answered, None
+            d.callback(frame_type)
+
+    def query(self, query):
+        self.answered = defer.Deferred()
+        self.send_frame(framing.QUERY, query.encode('utf-8'))
+        return self.answered
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {f"p{p}_ms": samples[min(len(samples) - 1, len(samples) * p // 100)] * 1000 for p in (50, 90, 99)}
+
+# `leaves` leaves connect to the ultrapeer on `port`, at most `concurrency` handshaking at once,
+# fires with them in the order their registrations were answered
+def connect_leaves(port, leaves, concurrency, prefix="leaf"):
+    from twisted.internet import endpoints, reactor, ssl
+    context_factory = ssl.CertificateOptions() # Nothing is resumed, every leaf pays for a full handshake like a real one would
+    semaphore = defer.DeferredSemaphore(concurrency)
+    registered = []
+
+    def connect(i):
+        d = defer.Deferred()
+        endpoint = endpoints.SSL4ClientEndpoint(reactor, "127.0.0.1", port, context_factory)
+        endpoints.connectProtocol(endpoint, LoadLeaf(f"{prefix}-{i}", d)).addErrback(d.errback)
+        return d.addCallback(lambda leaf: registered.append(leaf) or leaf)
+    return defer.gatherResults([semaphore.run(connect, i) for i in range(leaves)], consumeErrors=True).addCallback(lambda _: registered)
+
+# Polls until `check()` is true, fires with the seconds since `started`
+def wait_until(check, started, interval=0.001):
+    from twisted.internet import task
+    d = defer.Deferred()
+
+    def poll():
+        if check():
+            loop.stop()
+            d.callback(time.perf_counter() - started)
+    loop = task.LoopingCall(poll)
+    loop.start(interval).addErrback(d.errback)
+    return d
+
+def run_reactor(work, results):
+    from twisted.internet import reactor
+
+    def done(result):
+        results.put(result)
+        reactor.stop()
+
+    def failed(failure):
+        results.put({"error": failure.getErrorMessage()})
+        reactor.stop()
+    reactor.callWhenRunning(lambda: defer.maybeDeferred(work).addCallbacks(done, failed))
+    reactor.run()
+
+ECHO_LEAVES = 20 # Connections the unrecognised traffic comes in over
+ECHO_WARMUP = 2.5 # Seconds of echo traffic before timing, past the ultrapeers REPLY_DELAY so the replies are going out too
+
+# Every leaf asks `queries` times for random other leaves one after the other, all leaves at once,
+# so the latencies are what a busy ultrapeer gives
+def time_queries(connected, leaves, queries):
+    import random
+    latencies = []
+
+    def ask(leaf, left):
+        if not left:
+            return
+        asked = time.perf_counter()
+        return leaf.query(f"leaf-{random.randrange(leaves)}").addCallback(lambda _: latencies.append(time.perf_counter() - asked) or ask(leaf, left - 1))
+    query_start = time.perf_counter()
+    d = defer.gatherResults([ask(leaf, queries) for leaf in connected], consumeErrors=True)
+    return d.addCallback(lambda _: {"queries": len(latencies), "per_second": len(latencies) / (time.perf_counter() - query_start), **percentiles(latencies)})
+
+# Everything registers and the queries are timed, then timed again while `echo_per_second` frames the ultrapeer
+# does not recognise (the ones it echoes back later) come in alongside them. The replies being held back must not
+# hold up the queries
+def load_ultrapeer(port, leaves, queries, concurrency, echo_per_second, results):
+    from twisted.internet import reactor, task
+    stats = {}
+
+    def registered(connected, start):
+        elapsed = time.perf_counter() - start
+        stats["registration"] = {"leaves": leaves, "seconds": elapsed, "per_second": leaves / elapsed}
+        d = time_queries(connected, leaves, queries)
+        d.addCallback(lambda quiet: stats.update(query=quiet))
+        if echo_per_second:
+            d.addCallback(lambda _: connect_leaves(port, ECHO_LEAVES, concurrency, "echo"))
+            d.addCallback(with_echo, connected)
+        return d.addCallback(lambda _: stats)
+
+    def with_echo(echo_leaves, connected):
+        sent = [0]
+
+        def chatter(): # Every 10ms, round robin over the echo connections
+            for _ in range(echo_per_second // 100):
+                echo_leaves[sent[0] % len(echo_leaves)].send_frame(framing.TEXT, b"hello there ultrapeer")
+                sent[0] += 1
+        loop = task.LoopingCall(chatter)
+        loop.start(0.01)
+        start = time.perf_counter()
+
+        def done(loaded):
+            loop.stop()
+            loaded["echo_per_second"] = sent[0] / (time.perf_counter() - start)
+            stats["query_with_echo"] = loaded
+        d = task.deferLater(reactor, ECHO_WARMUP, time_queries, connected, leaves, queries)
+        return d.addCallback(done)
+
+    def work():
+        start = time.perf_counter()
+        return connect_leaves(port, leaves, concurrency).addCallback(registered, start)
+    run_reactor(work, results)
+
+def bench_ultrapeer_load(leaves, queries, concurrency=50, echo_per_second=2000, port=19999, fport=19444):
+    server = start_ultrapeer(port, fport)
+    try:
+        return in_process(load_ultrapeer, port, leaves, queries, concurrency, echo_per_second)
+    finally:
+        stop_ultrapeer(server)
+
+# Registers `leaves` with the ultrapeer and times how long until a tree joined to its forest has the last of them.
+# The tree is the real ForestFactory running here so it is its copy being looked at, not a query being routed
+# back to the ultrapeer. Changes go over in order so the last one arriving means they all have
+def load_forest(port, fport, leaves, concurrency, results):
+    from twisted.internet import reactor, ssl
+    import pubkeys
+    import ultrapeer
+    ultrapeer.forest = ultrapeer.Forest()
+    ultrapeer.forest_factory = tree = ultrapeer.ForestFactory()
+
+    def joined(_):
+        start = time.perf_counter()
+        return connect_leaves(port, leaves, concurrency).addCallback(registered, start)
+
+    def registered(connected, start):
+        last = time.perf_counter()
+        key_fingerprint = pubkeys.fingerprint(connected[-1].name)
+        d = wait_until(lambda: key_fingerprint in ultrapeer.forest.forest, last)
+        return d.addCallback(lambda converged: {"leaves": leaves, "after_last_ms": converged * 1000,
+                                                "total_s": time.perf_counter() - start,
+                                                "replicated": sum(1 for leaf in connected if pubkeys.fingerprint(leaf.name) in ultrapeer.forest.forest)})
+
+    def work():
+        reactor.connectSSL("127.0.0.1", fport, tree, ssl.CertificateOptions())
+        # Joined once the ultrapeers snapshot is in
+        return wait_until(lambda: tree.trees and tree.trees[0].last_seq is not None, time.perf_counter()).addCallback(joined)
+    run_reactor(work, results)
+
+def bench_forest_convergence(sizes, concurrency=50, port=19999, fport=19444):
+    results = {}
+    server = start_ultrapeer(port, fport)
+    try:
+        for leaves in sizes:
+            results[f"{leaves}_leaves"] = in_process(load_forest, port, fport, leaves, concurrency)
+    finally:
+        stop_ultrapeer(server)
+    return results
+
+# Enough to tell whether two runs are comparable
+def machine_info():
+    import platform
+    import subprocess
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit": commit, "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+def print_results(name, results):
+    print(name)
+    for case, values in results.items():
+        print(f"  {case}: " + ", ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}" for key, value in values.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Secure File Sender benchmarks",
+        description="Micro benchmarks for the file transfer and ultrapeer hot paths."
+    )
+    parser.add_argument("-S", "--size", dest="size", type=int, default=32,
+                        help="Size of the test payload in MB (default: 32)")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=65536,
+                        help="Chunk size in bytes (default: 65536)")
+    parser.add_argument("--leaves", dest="leaves", type=int, default=1000000,
+                        help="Registered leaves for the directory memory benchmark (default: 1000000)")
+    parser.add_argument("--load-leaves", dest="load_leaves", type=int, default=2000,
+                        help="Simulated leaves for the ultrapeer load and forest convergence benchmarks (default: 2000)")
+    parser.add_argument("--echo-rate", dest="echo_rate", type=int, default=2000,
+                        help="Unrecognised frames a second sent alongside the second round of queries in the ultrapeer load benchmark, 0 skips it (default: 2000)")
+    parser.add_argument("--only", dest="only", nargs="+", default=None,
+                        help="Only run these benchmarks, by the names used in the JSON output")
+    parser.add_argument("--json", dest="json", type=str, default=None,
+                        help="Also write the results here as JSON, to compare between releases")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    benchmarks = [
+        ("payload_encoding", "payload encoding", lambda: bench_payload_encoding(size, args.chunk_size)),
+        ("send_backends", "send backends", lambda: bench_send_backends(size, args.chunk_size)),
+        ("forest_flush", "forest flush, 1000 registrations 1ms apart", lambda: bench_forest_flush(1000, 0.001, [0, 0.01, 0.05, 0.2])),
+        ("forest_disconnects", "forest disconnects", lambda: bench_forest_disconnects([10000, 100000], 1000)),
+        ("forest_memory", "forest memory", lambda: bench_forest_memory(args.leaves)),
+        ("leaf_startup", "leaf startup", lambda: bench_leaf_startup(5, 20)),
+        ("tls_handshakes", "tls handshakes", lambda: bench_tls_handshakes(200)),
+        ("ultrapeer_load", f"ultrapeer load, {args.load_leaves} leaves", lambda: bench_ultrapeer_load(args.load_leaves, 10, echo_per_second=args.echo_rate)),
+        ("forest_convergence", "forest convergence", lambda: bench_forest_convergence([100, args.load_leaves])),
+        ("ultrapeer_workers", f"ultrapeer workers, {os.cpu_count()} cores", lambda: bench_ultrapeer_workers(2000, [1, 2, 4])),
+        # Runs the reactor in this process so it has to go last
+        ("peer_throughput", f"peer throughput, {args.size}MB from each peer", lambda: bench_peer_throughput(size, [1, 2, 4, 8])),
+    ]
+    report = {"machine": machine_info(), "args": vars(args), "results": {}}
+    for name, title, run in benchmarks:
+        if args.only is not None and name not in args.only:
+            continue
+        report["results"][name] = run()
+        print_results(title, report["results"][name])
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,98 @@
+import logging
+import lzma
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Flag byte in every chunk header saying how that chunk was packed
+RAW = 0
+
+# name -> (flag, compress) in order of preference, the receiver picks the first one it knows
+CODECS = {
+    "zlib": (1, lambda data: zlib.compress(data, 1)),
+    "lzma": (2, lambda data: lzma.compress(data, preset=0)),
+}
+
+def choose_codec(offered):
+    for name in offered.split(","):
+        if name in CODECS:
+            return name
+    return None
+
+def decompress(flag, data, max_length):
+    if flag == RAW:
+        return data
+    if flag == CODECS["zlib"][0]:
+        decompressor = zlib.decompressobj()
+    elif flag == CODECS["lzma"][0]:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unknown compression flag {flag}")
+    # Capped so a bad chunk cannot blow up into more than a chunk worth of memory
+    return decompressor.decompress(data, max_length + 1)
+
+# Compresses chunk by chunk so streaming still works, and gives up on data that does not shrink
+# (zips, media, anything already compressed) after the first few chunks so no more CPU gets wasted on it
+class AdaptiveCompressor:
+    SAMPLE_CHUNKS = 4
+    MIN_RATIO = 1.1
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.enabled = codec is not None
+        self.flag, self.compress = CODECS[codec] if self.enabled else (RAW, None)
+        self.sampled_in = 0
+        self.sampled_out = 0
+        self.sampled = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def compress_chunk(self, data):
+        self.bytes_in += len(data)
+        if not self.enabled:
+            self.bytes_out += len(data)
+            return RAW, data
+        start = time.thread_time()
+        packed = self.compress(data)
+        self.cpu_time += time.thread_time() - start
+        if self.sampled < self.SAMPLE_CHUNKS:
+            self.sampled += 1
+            self.sampled_in += len(data)
+            self.sampled_out += len(packed)
+            if self.sampled == self.SAMPLE_CHUNKS and self.sampled_in < self.sampled_out * self.MIN_RATIO:
+                logger.info(f"{self.codec} only got {self.sampled_in / self.sampled_out:.2f}x on the first chunks, sending the rest raw")
+                self.enabled = False
+        if len(packed) >= len(data):
+            self.bytes_out += len(data)
+            return RAW, data
+        self.bytes_out += len(packed)
+        return self.flag, packed
+
+    def stats(self):
+        ratio = self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+        return f"codec {self.codec or 'none'}, {self.bytes_in} bytes in, {self.bytes_out} bytes out, ratio {ratio:.2f}, cpu {self.cpu_time:.3f}s"
+
+# Receiving side stats, decompression happens on worker threads so cpu time is per thread
+class DecompressStats:
+    def __init__(self, codec):
+        self.codec = codec
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+        self.lock = threading.Lock()
+
+    def decompress(self, flag, data, max_length):
+        start = time.thread_time()
+        unpacked = decompress(flag, data, max_length)
+        with self.lock:
+            self.cpu_time += time.thread_time() - start
+            self.bytes_in += len(data)
+            self.bytes_out += len(unpacked)
+        return unpacked
+
+    def stats(self):
+        ratio = self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+        return f"codec {self.codec or 'none'}, {self.bytes_in} bytes in, {self.bytes_out} bytes out, ratio {ratio:.2f}, cpu {self.cpu_time:.3f}s"
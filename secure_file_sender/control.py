@@ -0,0 +1,86 @@
+import json
+import logging
+import socket
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+logger = logging.getLogger(__name__)
+
+# Drives a leaf run with --headless. One JSON object a line over a unix socket, a call like
+# {"id": 1, "method": "send", "params": [3, "file.bin"]} is answered with {"id": 1, "result": ...} or
+# {"id": 1, "error": "..."} once it is done. Params can also be an object of keyword arguments.
+# Any number of calls can be out at once on one connection, answers come back as they finish.
+# The methods are the ones on leaf.LeafClient
+class ControlProtocol(LineReceiver):
+    delimiter = b"\n"
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, client):
+        self.client = client
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line)
+            method = request["method"]
+            params = request.get("params", [])
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply({"id": None, "error": f"Malformed request: {e}"})
+            return
+        request_id = request.get("id")
+        if method not in self.client.METHODS:
+            self.reply({"id": request_id, "error": f"Unknown method {method}"})
+            return
+        call = getattr(self.client, method)
+        d = defer.maybeDeferred(call, **params) if isinstance(params, dict) else defer.maybeDeferred(call, *params)
+        d.addCallbacks(lambda result: self.reply({"id": request_id, "result": result}), self.failed, errbackArgs=(request_id, method))
+
+    def failed(self, failure, request_id, method):
+        logger.warning(f"Control call {method} failed: {failure.getErrorMessage()}")
+        self.reply({"id": request_id, "error": failure.getErrorMessage()})
+
+    def reply(self, response):
+        if self.connected: # Whoever asked may have gone while it was running
+            self.sendLine(json.dumps(response).encode('utf-8'))
+
+class ControlFactory(Factory):
+    def __init__(self, client):
+        self.client = client
+
+    def buildProtocol(self, addr):
+        return ControlProtocol(self.client)
+
+# Only whoever runs the leaf can drive it, a socket left behind by a leaf that died is replaced
+def listen(path, client):
+    logger.info(f"Listening for control commands on {path}")
+    return reactor.listenUNIX(path, ControlFactory(client), mode=0o600, wantPID=True)
+
+# The other end, for scripts. Blocks until each call is answered
+class ControlClient:
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("rb")
+        self.counter = 0
+
+    # Arguments go by position or by name, not both
+    def call(self, method, *params, **kwargs):
+        if params and kwargs:
+            raise TypeError("Give the arguments by position or by name, not both")
+        self.counter += 1
+        request = {"id": self.counter, "method": method, "params": kwargs or list(params)}
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b"\n")
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError("Leaf closed the control socket")
+            response = json.loads(line)
+            if response.get("id") == self.counter:
+                break
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
@@ -0,0 +1,73 @@
+import logging
+import struct
+from twisted.internet.protocol import Protocol
+
+logger = logging.getLogger(__name__)
+
+# Every message on every connection is a frame of [type: 1 byte][length: 4 bytes][payload: length bytes]
+# so one write no longer has to arrive as one read
+HEADER = struct.Struct("!BI")
+
+# Ultrapeer <-> leaf
+TEXT = 0x00
+REGISTRATION = 0x01
+QUERY = 0x02
+RESPONSE = 0x03
+ERROR = 0x04
+QUERY_BATCH = 0x05 # JSON list of keys or fingerprints
+RESPONSE_BATCH = 0x06 # JSON {"found": [[key, ip, port], ...], "unknown": [...]}
+
+# Ultrapeer <-> ultrapeer
+FOREST = 0x08
+FOREST_DELTA = 0x09
+FOREST_SYNC = 0x0A
+FOREST_QUERY = 0x0B # JSON {"id", "ttl", "query"}, a lookup this tree could not answer
+FOREST_ANSWER = 0x0C # JSON {"id", "found": [key, ip, port] or null}
+
+# Leaf <-> leaf
+HELLO = 0x10
+WELCOME = 0x11
+FILE_OFFER = 0x12
+FILE_ACCEPT = 0x13
+FILE_REFUSE = 0x14
+FILE_CHUNK = 0x15
+STREAM = 0x16
+FILE_DIGEST = 0x17
+KEEPALIVE = 0x18 # Empty, keeps pooled connections to other leaves from going quiet
+
+def pack(frame_type, payload):
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+class FramedProtocol(Protocol):
+    MAX_LENGTH = 16 * 1024 * 1024
+    _buffer = None
+
+    def dataReceived(self, data):
+        if self._buffer is None:
+            self._buffer = bytearray()
+        self._buffer.extend(data)
+        offset = 0
+        while len(self._buffer) - offset >= HEADER.size:
+            frame_type, length = HEADER.unpack_from(self._buffer, offset)
+            if length > self.MAX_LENGTH:
+                logger.error(f"Frame of {length} bytes is over the {self.MAX_LENGTH} byte limit, dropping connection")
+                self._buffer = None
+                self.transport.loseConnection()
+                return
+            start = offset + HEADER.size
+            end = start + length
+            if len(self._buffer) < end:
+                break
+            with memoryview(self._buffer) as view: # Copy the payload out once instead of slicing then copying
+                payload = view[start:end].tobytes()
+            offset = end
+            self.frame_received(frame_type, payload)
+            if self._buffer is None: # Connection was dropped while handling the frame
+                return
+        del self._buffer[:offset]
+
+    def frame_received(self, frame_type, payload):
+        raise NotImplementedError
+
+    def send_frame(self, frame_type, payload):
+        self.transport.write(pack(frame_type, payload))
@@ -0,0 +1,67 @@
+import logging
+import os
+from Crypto.PublicKey import RSA
+from OpenSSL import crypto
+
+logger = logging.getLogger(__name__)
+
+# Self signed key and cert for TLS, this cant be authenticated as its just a trust-me-bro one
+def make_self_signed():
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = "localhost"
+    cert.set_serial_number(1000)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(31536000)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, "sha256")
+    return key, cert
+
+# Private keys are only readable by whoever runs the leaf
+def write_private(path, data):
+    fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+
+# The leafs RSA identity plus the key and cert it uses for TLS, generated once and kept in `directory`
+# Making the keys is nearly all of a cold start so every later run just reads them back
+class IdentityStore:
+    def __init__(self, directory):
+        self.identity_path = os.path.join(directory, "identity.pem")
+        self.tls_path = os.path.join(directory, "tls.pem")
+
+    def load(self):
+        keypair = self.load_identity()
+        tls_key, tls_cert = self.load_tls()
+        return keypair, tls_key, tls_cert
+
+    def load_identity(self):
+        if os.path.exists(self.identity_path):
+            try:
+                with open(self.identity_path, "rb") as f:
+                    return RSA.import_key(f.read())
+            except (ValueError, IndexError, TypeError) as e:
+                logger.error(f"Could not read identity {self.identity_path}, making a new one: {e}")
+        keypair = RSA.generate(2048)
+        write_private(self.identity_path, keypair.export_key())
+        logger.info(f"Generated new identity in {self.identity_path}")
+        return keypair
+
+    def load_tls(self):
+        if os.path.exists(self.tls_path):
+            try:
+                with open(self.tls_path, "rb") as f:
+                    data = f.read()
+                key = crypto.load_privatekey(crypto.FILETYPE_PEM, data)
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM, data)
+                if not cert.has_expired():
+                    return key, cert
+                logger.info(f"TLS certificate in {self.tls_path} has expired, making a new one")
+            except crypto.Error as e:
+                logger.error(f"Could not read {self.tls_path}, making a new TLS key: {e}")
+        key, cert = make_self_signed()
+        write_private(self.tls_path, crypto.dump_privatekey(crypto.FILETYPE_PEM, key) + crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        return key, cert
@@ -1,19 +1,26 @@
 import argparse
-import ast
 import hashlib
 import logging
 import sys
 import threading
 import time
-from Crypto.PublicKey import RSA
-from OpenSSL import crypto, SSL
-import warnings
+from collections import OrderedDict
 import os
-from twisted.internet import reactor, ssl, threads
-from twisted.internet.protocol import Protocol, ClientFactory, Factory, ReconnectingClientFactory
+from twisted.internet import defer, reactor, ssl, task, threads
+from twisted.internet.protocol import ClientFactory, Factory, ReconnectingClientFactory
 from prompt_toolkit import PromptSession
 from prompt_toolkit.patch_stdout import patch_stdout
 import socket
+import framing
+import json
+import secrets
+import compression
+import control
+import identity
+import pubkeys
+import tlscontext
+import transfer
+import watchdog
 
 # logging stuff, this should be removed in release
 global logger
@@ -26,6 +33,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+STATE_DIR = f"./state/{socket.gethostname()}" # Whatever this leaf keeps between runs, its identity and contacts
+
 # This has so many variables that can probably be combined or just removed as a whole that I am sad
 class State:
     def __init__(self):
@@ -33,12 +42,10 @@ class State:
         self.connected_to_peer = False
         self.connecting_to_peer = False
         self.connector = False
-        self.filesend_requesting = False
-        self.filesend = False
-        self.filerecieve = False
-        self.filepath = ""
-        self.filename = ""
         self.chunk_size = 65536
+        self.send_backend = "buffered" # Or "mmap", only for files nothing else writes to, a file truncated while its chunks are still queued in the transport takes the whole leaf down, see transfer.SEND_BACKENDS
+        self.compression = True # Offer compressing files, it switches itself off for data that does not shrink
+        self.transfers = transfer.TransferTable() # Everything being sent and received with every peer, see PeerPool for the connections
 
 # ... take a guess
 def hash_string_to_port_range(input_string):
@@ -47,156 +54,718 @@ def hash_string_to_port_range(input_string):
     mapped_value = 5000 + (hash_int % (9999 - 5000 + 1))
     return mapped_value
 
-# This is just for handling a dictionary in a way that can be searched efficiently (even though it isnt)
+CONTACT_STALE_AFTER = 3600 # Seconds before a contacts address gets checked with the ultrapeer again
+CONTACT_POLL_INTERVAL = 300
+
+# Contacts indexed by public key, fingerprint and number, kept in an append only log next to the rest of
+# this leafs state so they survive a restart. Each line is the latest state of one contact and later lines win,
+# the log gets compacted on load once it has grown well past the number of contacts
+# Both the input thread and the reactor use it hence the lock
 class Contacts:
-    def __init__(self):
-        self.contacts_dict = {}
+    def __init__(self, path=None):
+        self.path = path
+        self.contacts_dict = {} # public key (or whatever was queried, until it resolves) -> contact
+        self.by_number = {} # number -> public key
+        self.by_fingerprint = {} # fingerprint hex -> public key
         self.contacts_counter = 0
+        self.loaded = path is None
+        self.log_file = None
+        self.lock = threading.RLock()
+
+    # Nothing is read until something needs the contacts
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            lines = 0
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    for line in f:
+                        try:
+                            contact = json.loads(line)
+                        except ValueError: # Half written line from a crash
+                            continue
+                        lines += 1
+                        contact["state"] = ""
+                        self.index_contact(contact)
+            if lines > 2 * len(self.contacts_dict) + 16:
+                self.compact()
+            self.log_file = open(self.path, "a")
+            logger.info(f"Loaded {len(self.contacts_dict)} contacts from {self.path}")
+
+    def index_contact(self, contact):
+        public_key = contact["public_key"]
+        self.contacts_dict[public_key] = contact
+        self.by_fingerprint[pubkeys.fingerprint(public_key).hex()] = public_key
+        self.by_number[contact["number"]] = public_key
+        self.contacts_counter = max(self.contacts_counter, contact["number"] + 1)
+
+    def save_contact(self, contact):
+        if self.log_file is None:
+            return
+        self.log_file.write(json.dumps({key: contact[key] for key in ("public_key", "number", "ip", "port", "checked")}) + "\n")
+        self.log_file.flush()
+
+    def compact(self):
+        with open(f"{self.path}.tmp", "w") as f:
+            for contact in self.contacts_dict.values():
+                if contact["number"] >= 0:
+                    f.write(json.dumps({key: contact[key] for key in ("public_key", "number", "ip", "port", "checked")}) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
 
     def initialize_contact(self, public_key):
-        try:
-            _test = self.contacts_dict[public_key]
-        except KeyError:
+        public_key = pubkeys.normalize(public_key)
+        with self.lock:
+            self.load()
+            if public_key in self.contacts_dict or public_key in self.by_fingerprint:
+                return
             self.contacts_dict[public_key] = {
                 "public_key": public_key,
                 "number": -1,
                 "ip": None,
                 "port": None,
+                "state": "",
             }
 
+    # New contacts get the next number, ones already known just get their address refreshed
     def finalize_contact(self, details):
-        try:
-            if self.contacts_dict[details[0]]["public_key"] == details[0] and self.contacts_dict[details[0]]["number"] == -1:
-                self.contacts_dict[details[0]] = {
-                    "public_key": details[0],
-                    "ip": details[1],
-                    "port": int(details[2]),
-                    "state": "",
-                    "number": self.contacts_counter
-                }
-                self.contacts_counter += 1
-        except KeyError:
-            logger.warning(f"Attempted to finalize non-existent contact: {details[0]}")
-        except IndexError:
-            logger.error(f"finalize_contact received incomplete details: {details}")
+        with self.lock:
+            self.load()
+            try:
+                public_key, ip, port = details[0], details[1], int(details[2])
+            except (IndexError, ValueError):
+                logger.error(f"finalize_contact received incomplete details: {details}")
+                return False
+            key_fingerprint = pubkeys.fingerprint(public_key).hex()
+            contact = self.contacts_dict.get(public_key)
+            if contact is None: # Queried by fingerprint, from here on the contact goes by its whole key
+                contact = self.contacts_dict.pop(key_fingerprint, None)
+            if contact is None:
+                logger.warning(f"Attempted to finalize non-existent contact: {public_key}")
+                return False
+            added = contact["number"] == -1
+            if added:
+                contact["number"] = self.contacts_counter
+            contact.update({"public_key": public_key, "ip": ip, "port": port, "state": "", "checked": time.time()})
+            self.index_contact(contact)
+            self.save_contact(contact)
+            return added
+
+    # Everything a batch query found, anything known that the ultrapeer has lost track of gets marked
+    def finalize_contacts(self, batch):
+        added = sum(1 for details in batch["found"] if self.finalize_contact(details))
+        with self.lock:
+            for query in map(pubkeys.normalize, batch["unknown"]):
+                contact = self.contacts_dict.get(self.by_fingerprint.get(query, query))
+                if contact is not None and contact["number"] >= 0:
+                    contact["state"] = " (unreachable)"
+        if batch["unknown"]:
+            logger.warning(f"Batch query could not resolve {len(batch['unknown'])} contacts")
+        return added
 
     def get_contacts(self):
-        for contact_info in self.contacts_dict.values():
-            print(f"{contact_info['number']}. {contact_info['public_key'][88:108]}{contact_info['state']}")
-        return self.contacts_dict
+        with self.lock:
+            self.load()
+            for contact_info in self.contacts_dict.values():
+                print(f"{contact_info['number']}. {contact_info['public_key'][88:108]}{contact_info['state']}")
+            return self.contacts_dict
 
     def get_contact(self, number):
-        for public_key, contact_info in self.contacts_dict.items():
-            if contact_info.get("number") == int(number):
-                return (contact_info.get("public_key"), contact_info.get("ip"), contact_info.get("port"))
-        return None
-    
-    def poll_contacts(self, _ip, _port): # WIP
+        with self.lock:
+            self.load()
+            public_key = self.by_number.get(int(number))
+            if public_key is None:
+                return None
+            contact_info = self.contacts_dict[public_key]
+            return (contact_info.get("public_key"), contact_info.get("ip"), contact_info.get("port"))
+
+    # A contact by its number, fingerprint or whole key, None until a query has found it
+    def find(self, contact):
+        with self.lock:
+            self.load()
+            if isinstance(contact, int) or str(contact).isdigit():
+                public_key = self.by_number.get(int(contact))
+            else:
+                contact = pubkeys.normalize(contact)
+                public_key = self.by_fingerprint.get(contact, contact)
+            contact_info = self.contacts_dict.get(public_key)
+            if contact_info is None or contact_info["number"] < 0:
+                return None
+            return {key: contact_info.get(key) for key in ("number", "public_key", "ip", "port", "checked")}
+
+    # Asks the ultrapeer where every contact that has not been seen for a while is now, in one batch
+    def poll_contacts(self, client):
+        with self.lock:
+            self.load()
+            stale_before = time.time() - CONTACT_STALE_AFTER
+            stale = [key_fingerprint for key_fingerprint, public_key in self.by_fingerprint.items() if self.contacts_dict[public_key].get("checked", 0) < stale_before]
+        if stale and client is not None:
+            logger.info(f"Revalidating {len(stale)} contacts")
+            client.send_line(json.dumps(stale), framing.QUERY_BATCH)
+
+# Incoming connection and file requests waiting on the user, each one is a Deferred that fires with
+# True or False from `accept`/`refuse`, or None when nobody answers in time. Only touched on the reactor
+# thread, the input loop goes through reactor.callFromThread
+class PendingDecisions:
+    TIMEOUT = 18
+
+    def __init__(self):
+        self.pending = {} # number -> (kind, owner, deferred, timeout call)
+        self.counter = 0
+
+    def ask(self, kind, owner, prompt):
+        self.counter += 1
+        number = self.counter
+        d = defer.Deferred()
+        timeout = reactor.callLater(self.TIMEOUT, self.expire, number)
+        self.pending[number] = (kind, owner, d, timeout)
+        print(f"[{number}] {prompt}\nUse command `accept {number}` to accept\nUse command `refuse {number}` to refuse")
+        return d
+
+    # Numbers the input loop can answer for, oldest first
+    def waiting(self, kind):
+        return [number for number, pending in list(self.pending.items()) if pending[0] == kind]
+
+    # Without a number the oldest request of that kind gets the answer
+    def decide(self, kind, accepted, number=None):
+        numbers = self.waiting(kind)
+        if number is None and numbers:
+            number = numbers[0]
+        if number not in numbers:
+            print(f"No pending request {number}" if number is not None else "Nothing waiting for an answer")
+            return
+        _, _, d, timeout = self.pending.pop(number)
+        timeout.cancel()
+        d.callback(accepted)
+
+    def expire(self, number):
+        _, _, d, _ = self.pending.pop(number)
+        print(f"Request {number} timed out")
+        d.callback(None)
+
+    # The connection that asked is gone so there is nothing left to answer
+    def drop(self, owner):
+        for number, (_, pending_owner, _, timeout) in list(self.pending.items()):
+            if pending_owner is owner:
+                del self.pending[number]
+                timeout.cancel()
+                logger.info(f"Dropped pending request {number}, its connection closed")
+
+# Stands in for PendingDecisions when nobody is at a prompt, every request of a kind gets the same answer straight away
+class AutoDecisions:
+    def __init__(self, connections=True, files=True):
+        self.answers = {"connect": connections, "file": files}
+
+    def ask(self, kind, owner, prompt):
+        logger.info(f"{prompt}, {'accepted' if self.answers[kind] else 'refused'} by policy")
+        return defer.succeed(self.answers[kind])
+
+    def waiting(self, kind):
+        return []
+
+    def decide(self, kind, accepted, number=None):
         pass
 
+    def drop(self, owner):
+        pass
+
+ACCEPT_POLICIES = { # --accept -> (connections, files)
+    "all": (True, True),
+    "connections": (True, False),
+    "files": (False, True), # Only over connections this leaf made
+    "none": (False, False),
+}
+
+PEER_KEEPALIVE = 30 # Seconds without sending anything before a pooled connection gets a keepalive
+PEER_DEAD_AFTER = 3 * PEER_KEEPALIVE # Nothing heard for this long and the connection is dropped
+PEER_IDLE_TIMEOUT = 600 # Connections nobody has chatted or sent a file over for this long get closed
+PEER_CONNECT_TIMEOUT = PendingDecisions.TIMEOUT + 12 # The other side gets this long to be welcomed, past its own prompt timing out
+MAX_PEERS = 32
+
+# Open connections to other leaves by the fingerprint of their key, so going back to a peer or sending it another
+# file reuses the connection instead of setting up a new one. `current` is the one `join` chats over, the rest
+# are kept alive with keepalives until they have gone unused for PEER_IDLE_TIMEOUT, past MAX_PEERS the least
+# recently used go first. Only touched on the reactor thread
+class PeerPool:
+    def __init__(self):
+        self.peers = OrderedDict() # fingerprint hex -> protocol, least recently used first
+        self.connecting = set() # fingerprints with a connection on the way
+        self.waiting = {} # fingerprint -> deferreds from `connect` that fire with the connection
+        self.deadlines = {} # fingerprint -> (timeout call, connector) for connections on the way
+        self.current = None
+        self.loop = None
+
+    def start(self):
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.start(PEER_KEEPALIVE, now=False)
+
+    # Fires with the connection once the peer has welcomed it
+    def connect(self, public_key, ip, port):
+        key_fingerprint = pubkeys.fingerprint(public_key).hex()
+        protocol = self.peers.get(key_fingerprint)
+        if protocol is not None and protocol.transport:
+            self.use(protocol)
+            print("Peer connected, reusing the open connection\nUse command `join` to start communicating")
+            logger.info(f"Reusing P2P connection to {ip}:{port}")
+            return defer.succeed(protocol)
+        d = defer.Deferred()
+        self.waiting.setdefault(key_fingerprint, []).append(d)
+        if key_fingerprint in self.connecting:
+            print("Already connecting to that peer")
+            return d
+        self.connecting.add(key_fingerprint)
+        p2p_factory = CommunicationClientFactory(public_key)
+        p2p_factory.peer_address = (ip, port)
+        p2p_factory.ssl_factory = ssl_factory
+        p2p_factory.key_fingerprint = key_fingerprint
+        connector = reactor.connectSSL(ip, port, p2p_factory, tlscontext.client_creator(ssl_factory, ip, port))
+        self.deadlines[key_fingerprint] = (reactor.callLater(PEER_CONNECT_TIMEOUT, self.connect_timed_out, key_fingerprint), connector)
+        program_state.connecting_to_peer = True
+        logger.info(f"Attempting P2P connection to {ip}:{port} with key {public_key[:20]}...")
+        return d
+
+    def connect_timed_out(self, key_fingerprint):
+        _, connector = self.deadlines.pop(key_fingerprint)
+        logger.info(f"P2P connection to {key_fingerprint[:16]} was not welcomed in {PEER_CONNECT_TIMEOUT}s, giving up")
+        print("Peer did not answer in time")
+        self.connect_failed(key_fingerprint, "Peer did not answer in time")
+        connector.disconnect()
+
+    def connect_failed(self, key_fingerprint, reason="Peer connection failed or was refused"):
+        self.cancel_deadline(key_fingerprint)
+        self.connecting.discard(key_fingerprint)
+        for d in self.waiting.pop(key_fingerprint, []):
+            d.errback(ConnectionError(reason))
+
+    # A connection either way made it through HELLO/WELCOME. Without a key (a leaf that does not send its own)
+    # it can still be chatted over, it just cannot be found again
+    def add(self, public_key, protocol):
+        previous = None
+        if public_key:
+            key_fingerprint = pubkeys.fingerprint(public_key).hex()
+            self.cancel_deadline(key_fingerprint)
+            self.connecting.discard(key_fingerprint)
+            previous = self.peers.pop(key_fingerprint, None)
+            if previous is not None and previous is not protocol and not previous.busy():
+                previous.transport.loseConnection() # Both sides connected to each other, the newest one wins
+            protocol.key_fingerprint = key_fingerprint
+            self.peers[key_fingerprint] = protocol
+            for d in self.waiting.pop(key_fingerprint, []):
+                d.callback(protocol)
+        if self.current is None or self.current is previous or not self.current.transport:
+            self.use(protocol)
+        else:
+            print("Another peer connected, `exit` this chat and `connect` to switch to it")
+        idle = [peer for peer in self.peers.values() if peer is not self.current and not peer.busy()]
+        for peer in idle[:max(0, len(self.peers) - MAX_PEERS)]:
+            logger.info(f"Closing least recently used P2P connection {peer.key_fingerprint[:16]}, over {MAX_PEERS} peers")
+            peer.transport.loseConnection()
+
+    def cancel_deadline(self, key_fingerprint):
+        timeout, _ = self.deadlines.pop(key_fingerprint, (None, None))
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+
+    def use(self, protocol):
+        self.current = protocol
+        protocol.last_used = time.monotonic()
+        if protocol.key_fingerprint in self.peers:
+            self.peers.move_to_end(protocol.key_fingerprint)
+        program_state.connected_to_peer = True
+        program_state.connecting_to_peer = False
+
+    # Leaving a chat keeps the connection around for the next `connect`
+    def leave(self):
+        if self.current is not None:
+            self.current.last_used = time.monotonic()
+        self.current = None
+
+    def remove(self, protocol):
+        if protocol.key_fingerprint is not None and self.peers.get(protocol.key_fingerprint) is protocol:
+            del self.peers[protocol.key_fingerprint]
+        if self.current is protocol:
+            self.current = None
+            program_state.connected_to_peer = False
+            print("Peer disconnected")
+
+    # Transfers keep a connection busy without any frames the other way, those are left alone
+    def tick(self):
+        now = time.monotonic()
+        for key_fingerprint, protocol in list(self.peers.items()):
+            if protocol.busy():
+                continue
+            if now - protocol.last_received > PEER_DEAD_AFTER:
+                logger.info(f"P2P connection {key_fingerprint[:16]} went quiet, dropping it")
+                protocol.transport.abortConnection()
+            elif protocol is not self.current and now - protocol.last_used > PEER_IDLE_TIMEOUT:
+                logger.info(f"Closing idle P2P connection {key_fingerprint[:16]}")
+                protocol.transport.loseConnection()
+            elif now - protocol.last_sent >= PEER_KEEPALIVE:
+                protocol.send_frame(framing.KEEPALIVE, b"")
+
+    def show(self):
+        if not self.peers:
+            print("No open peer connections")
+        now = time.monotonic()
+        for key_fingerprint, protocol in self.peers.items():
+            with contacts.lock:
+                public_key = contacts.by_fingerprint.get(key_fingerprint)
+                number = contacts.contacts_dict[public_key]["number"] if public_key is not None else "?"
+            print(f"{number}. {key_fingerprint[:16]} idle {now - protocol.last_used:.0f}s{' (chat)' if protocol is self.current else ''}")
+
+MAX_PENDING_WRITES = 8 # Chunks per connection waiting on a worker thread before reading is paused
+
+def finish_recieve_file(manifest):
+    logger.info(f"Received {manifest.filepath}: {manifest.decompressor.stats()}")
+    finished = manifest.finish()
+    program_state.transfers.finished.append({"file": manifest.filepath, "digest": manifest.expected_digest, "complete": finished})
+    if finished:
+        print(f"File received: {manifest.filepath}, sha256 chunk digest {manifest.expected_digest}")
+    elif manifest.is_complete() and manifest.expected_digest is not None:
+        print(f"File {manifest.filepath} did not match the senders digest and was discarded, send it again")
+    else:
+        print(f"File {manifest.filepath} incomplete ({manifest.rejected} chunks failed their digest), send it again to resume")
+
 # This protocol and factory handle the connection with another peer
-class CommunicationProtocol(Protocol):
+class CommunicationProtocol(framing.FramedProtocol):
     def __init__(self):
         self.connection_ready_event = threading.Event()
+        self.recieve_transfer = None
+        self.is_stream = False
+        self.pending_writes = 0
+        self.peer_public_key = None # Whoever connected in, if they said
+        self.key_fingerprint = None # Set once the connection is in the peer pool
+        self.sending = 0 # Files going out over this connection, one at a time and the rest waiting on send_lock
+        self.send_lock = defer.DeferredLock()
+        self.accepted = [] # Incoming files accepted here whose data has not started yet
+        self.replaced_protocol = None # Incoming only, the chat to hand back to if this turns out to be a stream
+        self.last_used = self.last_received = self.last_sent = time.monotonic()
 
     def connectionMade(self):
         logger.info("P2P connection established.")
+        if self.factory.stream is not None:
+            self.factory.connected = True
+            outgoing, ranges = self.factory.stream
+            self.send_line(outgoing.transfer_id, framing.STREAM)
+
+            def stream_sent(result):
+                self.end_file()
+                self.transport.loseConnection()
+                return result
+            self.send_file(outgoing, ranges).addBoth(stream_sent).chainDeferred(self.factory.stream_done)
+            return
         self.factory.peer_protocol = self
-        self.send_line(f"Cześć||{self.factory.public_key}") # Moved to inputloop
-
-    def dataReceived(self, data):
-        decoded_data = data.decode('utf-8')
-        if decoded_data.startswith("Cześć||") and not program_state.connected_to_peer:
-            if decoded_data.replace("Cześć||", "") == (f"{keypair.public_key().export_key()}".encode("'utf-8")).decode('utf-8'):
-                print("Peer requesting to connect\nUse command `accept` to accept communication\nUse command `refuse` to refuse communication")
-                timeout = 3 * 20
-                program_state.connecting_to_peer = True # This way the inputloop can decide if its connecting
-                while program_state.connecting_to_peer and timeout > 0: # wait for verdict... poorly
-                    time.sleep(0.3) # Just to make it a lil less spammy
-                    timeout -= 1
-                if timeout < 0:
-                    print("Request timed out")
-                    program_state.connecting_to_peer = False
-                    return
-                if program_state.connected_to_peer:
-                    self.send_line("Witajcie towarzysze||") # Welcome the comrade
-                else:
-                    self.connectionRefused()
-        elif decoded_data.startswith("Witajcie towarzysze||") and program_state.connecting_to_peer:
+        self.send_line(f"{self.factory.public_key}||¬{keypair.public_key().export_key()}", framing.HELLO) # Who this is for and who it is from
+
+    def frame_received(self, frame_type, payload):
+        self.last_received = time.monotonic()
+        if frame_type == framing.KEEPALIVE:
+            return
+        self.last_used = self.last_received
+        # File data stays as raw bytes, only the control frames get decoded
+        if frame_type == framing.FILE_CHUNK:
+            self.file_chunk_received(payload)
+            return
+        decoded_data = payload.decode('utf-8')
+        if frame_type == framing.STREAM:
+            transfer_id, _, stream_count = decoded_data.partition("||¬")
+            manifest = program_state.transfers.incoming.get(transfer_id)
+            if stream_count: # Sent down the offering connection before each file, its chunks follow and how many streams to wait for
+                if manifest is not None and int(stream_count) < 0: # Sent after the chunks, that many extra streams never connected
+                    manifest.streams += int(stream_count)
+                elif manifest is not None:
+                    manifest.streams = int(stream_count)
+                    self.recieve_transfer = manifest
+                    if manifest in self.accepted:
+                        self.accepted.remove(manifest)
+                return
+            # An extra connection for a transfer already accepted, it must not take over the chat
+            self.is_stream = True
+            if self.factory.peer_protocol is self:
+                self.factory.peer_protocol = self.replaced_protocol
+            self.replaced_protocol = None
+            if manifest is None:
+                logger.warning(f"Stream for unknown transfer {decoded_data}")
+                self.transport.loseConnection()
+                return
+            self.recieve_transfer = manifest
+            return
+        if frame_type == framing.HELLO:
+            self.replaced_protocol = None # Not a stream, nothing to hand back
+            recipient, _, sender = decoded_data.partition("||¬")
+            if recipient == (f"{keypair.public_key().export_key()}".encode("'utf-8")).decode('utf-8'):
+                self.peer_public_key = sender or None
+                program_state.connecting_to_peer = True
+                d = decisions.ask("connect", self, "Peer requesting to connect")
+                d.addCallback(self.connection_decided)
+        elif frame_type == framing.WELCOME and self.factory.peer_address is not None and self.key_fingerprint is None: # Only ever for connections made out
             print("Peer connected\nUse command `join` to start communicating")
-            program_state.connected_to_peer = True
-            program_state.connecting_to_peer = False
-        elif decoded_data.startswith("Plik?||") and not program_state.filesend_requesting:
-            file_path = decoded_data.removeprefix("Plik?||")
-            file_name = os.path.basename(file_path)
-            program_state.filename = file_name
-            print(f"Peer is attempting to send file {file_path}\nUse command `accept` to accept file\nUse command `refuse` to refuse file")
-            program_state.filesend_requesting = True
-            timeout = 3 * 20
-            while program_state.filesend_requesting and timeout > 0: # wait for verdict... poorly
-                time.sleep(0.3) # Just to make it a lil less spammy
-                timeout -= 1
-            if timeout < 0:
-                print("Request timed out")
-                program_state.filesend_requesting = False
+            peer_pool.add(self.factory.public_key, self)
+        elif frame_type == framing.FILE_OFFER:
+            try:
+                file_path, file_size, chunk_size, codecs, *offer_id = decoded_data.split("||¬")
+                file_size = int(file_size)
+                chunk_size = int(chunk_size)
+            except ValueError:
+                logger.error(f"Malformed file offer: {decoded_data}")
                 return
-            if program_state.filerecieve:
-                self.send_line("Plik||")
-            else:
-                self.send_line("nie ma pliku, dzięki||")
-        elif decoded_data.startswith("Plik||"):
-            print("File send accepted")
-            program_state.filesend = True
-            program_state.filesend_requesting = False
-            if not os.path.exists(program_state.filepath):
-                raise FileNotFoundError(f"File not found at: {program_state.filepath}")
-
-            with open(program_state.filepath, 'rb') as f:
-                chunk = f.read()  # Read the entire file
-                self.transport.write(f"¬||¬{chunk}".encode('utf-8'))
-        elif decoded_data.startswith("nie ma pliku, dzięki||") and program_state.filesend_requesting:
-            print("File send rejected")
-            program_state.filesend = False
-            program_state.filesend_requesting = False
-        elif decoded_data.startswith("¬||¬") and ( program_state.filerecieve or program_state.filesend ):
-            file_data = ast.literal_eval(decoded_data.replace("¬||¬", "")) # This could break horribly
-            filepath = program_state.filename
-            if not os.path.exists(filepath):
-                print(f"File not found. Creating: {filepath}")
-
-            if isinstance(file_data, str):
-                with open(filepath, 'ab', encoding='utf-8') as f:
-                    f.write(file_data)
-                print(f"String data appended to {filepath}")
-            elif isinstance(file_data, bytes):
-                with open(filepath, 'ab') as f:
-                    f.write(file_data)
-                print(f"Bytes data appended to {filepath}")
-            else:
-                raise TypeError("Data must be either str or bytes.")
+            if not transfer.valid_offer(file_size, chunk_size):
+                logger.error(f"Refusing file offer with a file size of {file_size} and chunk size of {chunk_size}")
+                self.send_line(f"{''.join(offer_id)}||¬zły rozmiar", framing.FILE_REFUSE)
+                return
+            d = decisions.ask("file", self, f"Peer is attempting to send file {file_path}")
+            d.addCallback(self.file_offer_decided, os.path.basename(file_path), file_size, chunk_size, codecs, "".join(offer_id))
+        elif frame_type == framing.FILE_ACCEPT:
+            try:
+                accepted = json.loads(decoded_data)
+                offer = program_state.transfers.answer(accepted.get("offer"), self)
+            except (ValueError, AttributeError): # No telling which offer it was for, closing fails every offer on here
+                logger.error(f"Malformed file accept, closing the connection: {decoded_data}")
+                self.transport.loseConnection()
+                return
+            if offer is None:
+                logger.warning(f"Accept for an offer that is not open: {decoded_data}")
+                return
+            # The offer is out of the table from here so it has to be finished off here, or whatever waits on it never hears
+            try:
+                outgoing = transfer.OutgoingTransfer(accepted["id"], offer.filepath, offer.chunk_size, accepted["codec"])
+                ranges = accepted["ranges"]
+            except (KeyError, OSError) as e:
+                logger.error(f"File send of {offer.filepath} could not start: {e!r}")
+                print(f"File send of {offer.filepath} failed: {e}")
+                if "id" in accepted:
+                    self.send_line(f"{accepted['id']}||¬nie da się wysłać", framing.FILE_REFUSE) # The receiver drops what it set up for it
+                else:
+                    self.transport.loseConnection()
+                offer.done.errback(e)
+                return
+            print(f"File send of {offer.filepath} accepted")
+            program_state.transfers.outgoing[outgoing.transfer_id] = outgoing
+            self.sending += 1
+            # Chunks do not say which file they are from so a connection sends one file at a time, the rest queue up
+            d = self.send_lock.run(self.send_transfer, outgoing, ranges, offer.streams)
+            d.addBoth(lambda result: self.file_sent(outgoing) or result)
+            d.chainDeferred(offer.done)
+        elif frame_type == framing.FILE_DIGEST:
+            if self.recieve_transfer is not None:
+                self.recieve_transfer.expected_digest = decoded_data
+        elif frame_type == framing.FILE_REFUSE:
+            refused_id = decoded_data.partition("||¬")[0]
+            offer = program_state.transfers.answer(refused_id, self)
+            if offer is not None:
+                print(f"File send of {offer.filepath} rejected")
+                offer.done.callback(None)
+                return
+            # Or the sender could not start a file accepted from it
+            for manifest in self.accepted:
+                if manifest.transfer_id == refused_id:
+                    print(f"Peer could not send {manifest.filepath}")
+                    self.accepted.remove(manifest)
+                    program_state.transfers.incoming.pop(manifest.transfer_id, None)
+                    manifest.close()
+                    break
         else:
             print(f"\r<<< {decoded_data}")
-            
+
+    # A timed out request gets closed too, otherwise the other side keeps waiting on a connection nobody pools
+    def connection_decided(self, accepted):
+        if not decisions.waiting("connect"):
+            program_state.connecting_to_peer = False
+        if not self.transport:
+            return
+        if accepted:
+            self.send_line("Witajcie towarzysze", framing.WELCOME) # Welcome the comrade
+            peer_pool.add(self.peer_public_key, self)
+        else:
+            self.connectionRefused()
+
+    # A timed out offer gets refused too so the sender is not left waiting on it
+    def file_offer_decided(self, accepted, file_name, file_size, chunk_size, codecs, offer_id):
+        if not self.transport:
+            return
+        if not accepted:
+            self.send_line(f"{offer_id}||¬nie ma pliku, dzięki", framing.FILE_REFUSE)
+            return
+        # Picks up a previous partial copy if there is one and only asks for what is missing
+        manifest = transfer.TransferManifest(program_state.transfers.receive_path(file_name), file_size, chunk_size)
+        if manifest.open():
+            print(f"Resuming {file_name}, {manifest.received_bytes()} of {file_size} bytes already received")
+        manifest.transfer_id = secrets.token_hex(8)
+        codec = compression.choose_codec(codecs)
+        manifest.decompressor = compression.DecompressStats(codec)
+        manifest.streams = 1
+        program_state.transfers.incoming[manifest.transfer_id] = manifest
+        self.accepted.append(manifest)
+        self.send_line(json.dumps({"id": manifest.transfer_id, "ranges": manifest.missing_ranges(), "codec": codec, "offer": offer_id}), framing.FILE_ACCEPT)
+
+    def offer_file(self, filepath, streams):
+        offer = program_state.transfers.offer(filepath, streams, program_state.chunk_size, self)
+        codecs = ",".join(compression.CODECS) if program_state.compression else ""
+        self.send_line(f"{filepath}||¬{os.path.getsize(filepath)}||¬{offer.chunk_size}||¬{codecs}||¬{offer.offer_id}", framing.FILE_OFFER)
+        return offer.done
+
+    def send_transfer(self, outgoing, ranges, streams):
+        # Extra streams need somewhere to connect to so they only work from the connecting side
+        groups = transfer.split_ranges(ranges, streams if self.factory.peer_address else 1, outgoing.chunk_size)
+        self.send_line(f"{outgoing.transfer_id}||¬{len(groups)}", framing.STREAM)
+        stream_factories = [self.open_stream(outgoing, group) for group in groups[1:]]
+        sends = [self.send_file(outgoing, groups[0])]
+        sends += [stream_factory.stream_done for stream_factory in stream_factories]
+        sends.append(outgoing.hash_skipped(ranges)) # Whatever the receiver already has still counts towards the digest
+
+        # Nothing more goes down this connection until every send has settled, one stream failing early would
+        # otherwise end the file while this connection is still producing it. The receiver waits for an end of
+        # file from every stream so it is told about the ones that never connected and never will
+        def settled(results):
+            never_connected = sum(1 for stream_factory in stream_factories if not stream_factory.connected)
+            if never_connected:
+                self.send_line(f"{outgoing.transfer_id}||¬-{never_connected}", framing.STREAM)
+            for sent, result in results:
+                if not sent:
+                    return result
+            return results
+
+        # The digest can only go once every stream is done, and has to land before the end of file
+        def all_sent(_):
+            digest = outgoing.digest()
+            self.send_line(digest, framing.FILE_DIGEST)
+            print(f"File {outgoing.filepath} sent, sha256 chunk digest {digest}")
+            logger.info(f"Sent {outgoing.filepath}: {outgoing.compressor.stats()}")
+            return digest
+
+        def not_sent(failure):
+            logger.error(f"File send of {outgoing.filepath} failed: {failure.getErrorMessage()}")
+            print(f"File {outgoing.filepath} not fully sent, send it again to resume")
+            return failure
+        d = defer.DeferredList(sends, consumeErrors=True)
+        d.addCallback(settled)
+        d.addCallbacks(all_sent, not_sent)
+        d.addBoth(lambda result: self.end_file() or result)
+        return d
+
+    # Each chunk goes out as its own FILE_CHUNK frame tagged with its offset and sha256
+    # The sender only reads the next chunk once the transport has drained so memory stays flat no matter the file size
+    def send_file(self, outgoing, ranges):
+        f = open(outgoing.filepath, 'rb')
+        sender = transfer.make_file_sender(program_state.send_backend, f, ranges, outgoing.chunk_size, outgoing.digests, outgoing.compressor)
+        d = sender.beginFileTransfer(self.transport)
+
+        def file_done(result):
+            sender.close()
+            f.close()
+            return result
+        d.addBoth(file_done)
+        return d
+
+    # An empty chunk tells the receiver this connection has nothing more for the file
+    def end_file(self):
+        if self.transport:
+            self.transport.write(transfer.pack_chunk(0, b""))
+
+    def file_sent(self, outgoing):
+        program_state.transfers.outgoing.pop(outgoing.transfer_id, None)
+        self.sending -= 1
+        self.last_used = time.monotonic()
+
+    # Anything the pool should not close under it
+    def busy(self):
+        return self.sending > 0 or self.recieve_transfer is not None or len(self.accepted) > 0
+
+    # Sends some of the ranges of a file over another connection to the same peer, the factory's stream_done
+    # fires once it is done
+    def open_stream(self, outgoing, ranges):
+        stream_factory = CommunicationClientFactory(self.factory.public_key)
+        stream_factory.stream = (outgoing, ranges)
+        stream_factory.stream_done = defer.Deferred()
+        peer_ip, peer_port = self.factory.peer_address
+        reactor.connectSSL(peer_ip, peer_port, stream_factory, tlscontext.client_creator(self.factory.ssl_factory, peer_ip, peer_port))
+        return stream_factory
+
+    # Hashing and writing happen on worker threads, reading off the connection pauses while too many are queued
+    def file_chunk_received(self, payload):
+        manifest = self.recieve_transfer
+        if manifest is None:
+            logger.warning("File chunk received with no transfer in progress")
+            return
+        offset, digest, flag, file_data = transfer.unpack_chunk(payload)
+        if not file_data:
+            self.close_recieve_file()
+            return
+        try:
+            index = manifest.check_chunk(offset)
+        except ValueError as e:
+            logger.error(f"Dropping file chunk: {e}")
+            return
+        d = threads.deferToThread(manifest.store_chunk, offset, file_data, flag)
+        d.addCallback(lambda stored: manifest.record_chunk(index, stored, digest))
+        d.addErrback(lambda failure: logger.error(f"Writing chunk {index} of {manifest.filepath} failed: {failure.getErrorMessage()}"))
+        manifest.pending.add(d)
+        self.pending_writes += 1
+        if self.pending_writes == MAX_PENDING_WRITES:
+            self.transport.pauseProducing()
+
+        def written(result):
+            manifest.pending.discard(d)
+            self.pending_writes -= 1
+            if self.pending_writes == MAX_PENDING_WRITES - 1 and self.transport:
+                self.transport.resumeProducing()
+            return result
+        d.addBoth(written)
+
+    # Called once per stream, the file is only finished off when the last stream is done with it
+    def close_recieve_file(self):
+        manifest = self.recieve_transfer
+        if manifest is None:
+            return
+        self.recieve_transfer = None
+        manifest.streams -= 1
+        if manifest.streams > 0:
+            return
+        program_state.transfers.incoming.pop(manifest.transfer_id, None)
+        defer.DeferredList(list(manifest.pending)).addCallback(lambda _: finish_recieve_file(manifest))
+
     def connectionRefused(self):
-        program_state.connected_to_peer = False
         program_state.connecting_to_peer = False
         self.transport.loseConnection()
 
-    def send_line(self, line):
+    def send_line(self, line, frame_type=framing.TEXT):
         if self.transport and line:
-            self.transport.write(line.encode('utf-8'))
+            self.last_used = time.monotonic()
+            self.send_frame(frame_type, line.encode('utf-8'))
             logger.info(f"P2P Sent: {line}")
         elif not self.transport:
             logger.warning("P2P Cannot send data, transport is not available.")
 
+    def send_frame(self, frame_type, payload):
+        self.last_sent = time.monotonic()
+        super().send_frame(frame_type, payload)
+
     def connectionLost(self, reason):
         logger.info(f"P2P connection lost: {reason.getErrorMessage()}")
+        decisions.drop(self)
+        peer_pool.remove(self)
+        if self.recieve_transfer is not None and not self.is_stream:
+            self.recieve_transfer.streams = 1 # The offering connection is gone so nothing else is coming
+        self.close_recieve_file() # Manifest stays behind if it is incomplete so the transfer can be resumed
+        for manifest in self.accepted: # Never started, a later offer picks them up from their manifest
+            program_state.transfers.incoming.pop(manifest.transfer_id, None)
+            manifest.close()
+        self.accepted = []
+        self.replaced_protocol = None
+        program_state.transfers.drop(self)
         if hasattr(self.factory, 'peer_protocol') and self.factory.peer_protocol == self:
             self.factory.peer_protocol = None
 
 class CommunicationClientFactory(ClientFactory):
     protocol = CommunicationProtocol
     peer_protocol = None
+    peer_address = None # Only known when connecting out, along with the ssl factory used
+    ssl_factory = None
+    key_fingerprint = None # Set by the peer pool for connections it made
+    stream = None # (outgoing transfer, ranges) when this connection only carries part of a file
+    stream_done = None
+    connected = False # Whether a stream connection got as far as sending anything
 
     def __init__(self, public_key):
         self.public_key = public_key
@@ -204,44 +773,85 @@ class CommunicationClientFactory(ClientFactory):
     def buildProtocol(self, addr):
         proto = self.protocol()
         proto.factory = self
+        if self.peer_address is None: # Only incoming connections can turn out to be streams, and only until they say which
+            proto.replaced_protocol = self.peer_protocol
         self.peer_protocol = proto
         return proto
 
     def clientConnectionFailed(self, connector, reason):
         logger.error(f"P2P Connection failed: {reason.getErrorMessage()}")
+        if self.stream_done is not None and not self.stream_done.called:
+            self.stream_done.errback(reason)
+        elif self.stream is None:
+            print("Peer connection failed")
+            peer_pool.connect_failed(self.key_fingerprint)
+            program_state.connecting_to_peer = False
 
+    # Whether it was the chat is up to the peer pool, see PeerPool.remove
     def clientConnectionLost(self, connector, reason):
+        if self.stream is not None: # Extra transfer streams have nothing to do with the chat
+            return
         logger.info(f"Resetting P2P connection related flags and variables")
-        program_state.connected_to_peer = False
+        peer_pool.connect_failed(self.key_fingerprint)
         program_state.connecting_to_peer = False
         if hasattr(self, 'peer_protocol') and self.peer_protocol and self.peer_protocol.transport:
             self.peer_protocol.transport = None
             self.peer_protocol = None
 
 # This protocol and factory handle the connection with the ultrapeer
-class LeafProtocol(Protocol):
+class LeafProtocol(framing.FramedProtocol):
     def __init__(self, factory):
         self.factory = factory
         self.connection_ready_event = threading.Event()
+        self.queries = {} # fingerprint hex -> deferreds from `query` waiting on the answer
 
     def connectionMade(self):
         logger.info("Connection established to ultrapeer.")
         self.factory.client_instance = self
-        self.connection_ready_event.set()
         program_state.connected_to_ultrapeer = True
-        self.send_line(f"Registration¬|¬{keypair.public_key().export_key()}¬|¬{p2p_port}")
+        identity_ready.addCallback(self.register) # On a cold start the TLS key can be done well before the identity
 
-    def dataReceived(self, data):
-        decoded_data = data.decode('utf-8')
-        if decoded_data.startswith("Response||¬"):
-            response = decoded_data.replace("Response||¬", "").split("||¬")
+    def register(self, keypair):
+        self.connection_ready_event.set()
+        self.send_line(f"{keypair.public_key().export_key()}¬|¬{p2p_port}", framing.REGISTRATION)
+        logger.info(f"Registered with the ultrapeer {time.perf_counter() - started_at:.3f}s after starting")
+        # Contacts load off the reactor thread, then anything stale gets checked straight away
+        threads.deferToThread(contacts.load).addCallback(lambda _: contacts.poll_contacts(self))
+        return keypair
+
+    def frame_received(self, frame_type, payload):
+        decoded_data = payload.decode('utf-8')
+        if frame_type == framing.RESPONSE:
+            response = decoded_data.split("||¬")
             contacts.finalize_contact(response)
+            for d in self.queries.pop(pubkeys.fingerprint(response[0]).hex(), []):
+                d.callback(contacts.find(response[0]))
+        elif frame_type == framing.RESPONSE_BATCH:
+            batch = json.loads(decoded_data)
+            added = contacts.finalize_contacts(batch)
+            logger.info(f"Batch response, {len(batch['found'])} found, {added} new, {len(batch['unknown'])} unknown")
+            if added: # Background revalidation stays quiet
+                print(f"Added {added} contacts, {len(batch['unknown'])} could not be found")
+        elif frame_type == framing.ERROR:
+            print(f"\r<< {decoded_data}")
+            query, _, reason = decoded_data.partition("||¬")
+            for d in self.queries.pop(pubkeys.query_fingerprint(query).hex(), []):
+                d.errback(LookupError(f"{reason} {query}"))
         else:
             print(f"\r<< {decoded_data}")
 
-    def send_line(self, line):
+    # Fires with the contact once the ultrapeer has found it
+    def query(self, query):
+        query = pubkeys.normalize(query)
+        contacts.initialize_contact(query)
+        d = defer.Deferred()
+        self.queries.setdefault(pubkeys.query_fingerprint(query).hex(), []).append(d)
+        self.send_line(query, framing.QUERY)
+        return d
+
+    def send_line(self, line, frame_type=framing.TEXT):
         if self.transport and line:
-            self.transport.write(line.encode('utf-8'))
+            self.send_frame(frame_type, line.encode('utf-8'))
             logger.info(f"Sent: {line}")
         elif not self.transport:
             logger.warning("Cannot send data, transport is not available.")
@@ -249,6 +859,10 @@ class LeafProtocol(Protocol):
     def connectionLost(self, reason):
         logger.info(f"Connection lost from ultrapeer: {reason.getErrorMessage()}")
         self.connection_ready_event.clear()
+        queries, self.queries = self.queries, {}
+        for waiting in queries.values():
+            for d in waiting:
+                d.errback(ConnectionError("Connection to the ultrapeer lost"))
         if self.factory.client_instance == self:
             self.factory.client_instance = None
         self.factory.signal_input_thread_shutdown()
@@ -279,9 +893,24 @@ class LeafFactory(ReconnectingClientFactory):
     def should_input_thread_shutdown(self):
         return self._input_thread_shutdown_event.is_set()
 
+# `accept 3` -> 3, plain `accept` -> None
+def decision_number(user_input):
+    parts = user_input.split()
+    if len(parts) > 1 and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+# What `accept`/`refuse` answers: the request with that number, or without one the oldest connection then file waiting
+def decision_kind(user_input):
+    number = decision_number(user_input)
+    for kind in ("connect", "file"):
+        numbers = decisions.waiting(kind)
+        if numbers and (number is None or number in numbers):
+            return kind
+    return None
+
 # This loop handles all the input from the user... Poorly
 def input_loop(prompt_session, factory):
-    global p2p_factory # This is needed to access it i think
     logger.info("Input thread started. Waiting for connection to ultrapeer...")
     connection_entered = False
 
@@ -312,36 +941,60 @@ def input_loop(prompt_session, factory):
                     if user_input.lower() == "identity":
                         logger.info("Identity requested")
                         print(f"Identity:\n{keypair.public_key().export_key()}")
-                    elif user_input.lower() == "accept" and program_state.connecting_to_peer:
-                        print("Accepting connection\nUse command `join` to start communicating")
-                        program_state.connected_to_peer = True
-                        program_state.connecting_to_peer = False
-                        pass
-                    elif user_input.lower() == "refuse" and program_state.connecting_to_peer:
-                        print("Refusing connection")
-                        program_state.connecting_to_peer = False
+                        print(f"Fingerprint:\n{pubkeys.fingerprint(f'{keypair.public_key().export_key()}').hex()}")
+                    elif user_input.split(" ")[0].lower() in ("accept", "refuse") and decision_kind(user_input) == "connect":
+                        accepted = user_input.split(" ")[0].lower() == "accept"
+                        print("Accepting connection\nUse command `join` to start communicating" if accepted else "Refusing connection")
+                        reactor.callFromThread(decisions.decide, "connect", accepted, decision_number(user_input))
+                    elif user_input.split(" ")[0].lower() in ("accept", "refuse") and decision_kind(user_input) == "file":
+                        # Pooled connections stay open outside the chat so their peers can still offer files
+                        accepted = user_input.split(" ")[0].lower() == "accept"
+                        print("Accepting file" if accepted else "Refusing file")
+                        reactor.callFromThread(decisions.decide, "file", accepted, decision_number(user_input))
                     elif user_input.lower() == "exit" or program_state.connected_to_ultrapeer == False:
                         factory.signal_input_thread_shutdown()
                     elif user_input.lower() == "contacts":
                         contacts.get_contacts()
+                    elif user_input.lower() == "peers":
+                        reactor.callFromThread(peer_pool.show)
                     elif user_input.lower() == "help":
                         print("Ultrapeer commands:")
                         print("identity - display identity for querying")
-                        print("accept - accept an incoming p2p chat connection")
-                        print("refuse - refuse an incoming p2p chat connection")
+                        print("accept [n] - accept an incoming p2p chat connection or file, the oldest one without n")
+                        print("refuse [n] - refuse an incoming p2p chat connection or file, the oldest one without n")
                         print("exit - exit program")
                         print("contacts - display contacts")
-                        print("query [pubkey] - queries and adds the peer specified by pubkey to contacts")
-                        print("connect [contact number] - connects to leaf specified in contacts at contact number")
+                        print("query [pubkey|fingerprint] - queries and adds the peer specified by pubkey or its fingerprint to contacts")
+                        print("query [fingerprint] [fingerprint] ... - queries several fingerprints in one go")
+                        print("queryfile [path] - queries every pubkey or fingerprint in the file, one per line, in one go")
+                        print("connect [contact number] - connects to leaf specified in contacts at contact number, reusing an open connection")
+                        print("peers - display open peer connections")
                         print("join - enteres the p2p chat connection")
                     elif user_input.lower() == "join" and program_state.connected_to_peer:
                         connection_entered = True
+                    elif user_input.split(" ")[0].lower() == "queryfile" or (user_input.split(" ")[0].lower() == "query" and len(user_input.split()) > 2 and all(pubkeys.is_fingerprint(part) for part in user_input.split()[1:])):
+                        # One key or fingerprint per line in the file, or several fingerprints after `query`, all resolved in one round trip
+                        current_client = factory.client_instance
+                        if user_input.split(" ")[0].lower() == "queryfile":
+                            try:
+                                with open(user_input[len("queryfile ")::]) as f:
+                                    queries = [line.strip() for line in f if line.strip()]
+                            except OSError as e:
+                                print(f"Could not read {user_input[len('queryfile ')::]}: {e}")
+                                queries = []
+                        else:
+                            queries = user_input.split()[1:]
+                        if current_client and queries:
+                            for query in queries:
+                                contacts.initialize_contact(query)
+                            reactor.callFromThread(current_client.send_line, json.dumps(queries), framing.QUERY_BATCH)
+                        elif not current_client:
+                            logger.warning("No connection to ultrapeer to send query.")
                     elif user_input.split(" ")[0].lower().startswith("query"):
                         current_client = factory.client_instance
                         if current_client:
-                            query = f"Query¬¬|{user_input[6:]}"
                             contacts.initialize_contact(user_input[6:])
-                            reactor.callFromThread(current_client.send_line, query)
+                            reactor.callFromThread(current_client.send_line, user_input[6:], framing.QUERY)
                         else:
                             logger.warning("No connection to ultrapeer to send query.")
                     elif user_input.lower().startswith("connect"):
@@ -352,12 +1005,7 @@ def input_loop(prompt_session, factory):
                             contact_number = parts[1]
                             details = contacts.get_contact(contact_number)
                             if details:
-                                peer_public_key, peer_ip, peer_port = details
-                                p2p_factory = CommunicationClientFactory(peer_public_key)
-                                ssl_factory = SSLFactory()
-                                reactor.connectSSL(peer_ip, peer_port, p2p_factory, ssl_factory)
-                                program_state.connecting_to_peer = True
-                                logger.info(f"Attempting P2P connection to {peer_ip}:{peer_port} with key {peer_public_key[:20]}...")
+                                reactor.callFromThread(peer_pool.connect, *details)
                             else:
                                 print(f"Error: Contact with number {contact_number} not found.")
                         else:
@@ -374,54 +1022,55 @@ def input_loop(prompt_session, factory):
                     # Handling commands from the user to the other peer or itself
                     user_input = prompt_session.prompt(">>> ")
                     try:
+                        peer_protocol = peer_pool.current
+                        if peer_protocol is None:
+                            raise Exception("No peer connection")
                         if user_input.lower() == "exit":
-                            try:
-                                reactor.callFromThread(p2p_factory.peer_protocol.connectionRefused)
-                            except:
-                                reactor.callFromThread(p2p_factory_listen.peer_protocol.connectionRefused)
+                            print("Left the chat, the connection stays open for a while so `connect` comes straight back")
+                            program_state.connected_to_peer = False
+                            reactor.callFromThread(peer_pool.leave)
+                        elif user_input.lower() == "close":
+                            reactor.callFromThread(peer_protocol.connectionRefused)
                         elif user_input.lower() == "help":
                             print("Leaf commands:")
-                            print("exit - disconnect from peer")
-                            print("send [filepath] - send file at path")
-                            print("accept - accept an incoming file")
-                            print("refuse - refuse an incoming file")
+                            print("exit - leave the chat, the connection is kept for a while")
+                            print("close - disconnect from peer")
+                            print("send [--streams n] [filepath] - send file at path, optionally split over n parallel connections")
+                            print("accept [n] - accept an incoming file, the oldest one without n")
+                            print("refuse [n] - refuse an incoming file, the oldest one without n")
+                            print(f"backend [{'|'.join(transfer.SEND_BACKENDS)}] - choose how outgoing files are read")
+                            print("compress [on|off] - offer to compress outgoing files")
+                        elif user_input.lower().startswith("compress"):
+                            setting = user_input[len("compress")::].strip().lower()
+                            if setting in ("on", "off"):
+                                program_state.compression = setting == "on"
+                            print(f"Compression {'on' if program_state.compression else 'off'}")
+                        elif user_input.lower().startswith("backend"):
+                            backend = user_input[len("backend")::].strip().lower()
+                            if backend in transfer.SEND_BACKENDS:
+                                program_state.send_backend = backend
+                            print(f"Sending files with the {program_state.send_backend} backend")
                         elif user_input.startswith("send") or user_input.startswith("Send"):
                             print("Requesting to send file to peer")
-                            program_state.filepath = user_input[len("send ")::] # Not sure why this sometimes just doesnt work
-                            file_size = os.path.getsize(program_state.filepath) # Just gunna assume thisll work just fine
-                            if file_size > 1024 * 5:
-                                print("File greater than limit (5kb)")
-                            else:
-                                try:
-                                    reactor.callFromThread(p2p_factory.peer_protocol.send_line, f"Plik?||{user_input[5::]}")
-                                    success = True
-                                except:
-                                    try:
-                                        reactor.callFromThread(p2p_factory_listen.peer_protocol.send_line, f"Plik?||")
-                                        success = True
-                                    except:
-                                        success = False
-                                if not success:
-                                    raise Exception("Both send attempts failed")
-                        elif user_input.lower() == "accept" and program_state.filesend_requesting:
-                            print("Accepting file")
-                            program_state.filerecieve = True
-                            program_state.filesend_requesting = False
-                            pass
-                        elif user_input.lower() == "refuse" and program_state.filesend_requesting:
-                            print("Refusing file")
-                            program_state.filesend_requesting = False
-                        try:
-                            reactor.callFromThread(p2p_factory.peer_protocol.send_line, user_input)
-                            success = True
-                        except:
-                            try:
-                                reactor.callFromThread(p2p_factory_listen.peer_protocol.send_line, user_input)
-                                success = True
-                            except:
-                                success = False
-                        if not success:
-                            raise Exception("Both send attempts failed")
+                            file_arg = user_input[len("send ")::] # Not sure why this sometimes just doesnt work
+                            streams = 1
+                            if file_arg.startswith("--streams "):
+                                _, streams, file_arg = file_arg.split(" ", 2)
+                                streams = max(1, int(streams))
+                            if not os.path.isfile(file_arg):
+                                print(f"File not found at: {file_arg}")
+                            else: # Any number of offers can be out at once, each is answered on its own
+                                reactor.callFromThread(peer_protocol.offer_file, file_arg, streams)
+                        elif user_input.split(" ")[0].lower() in ("accept", "refuse") and decisions.waiting("file"):
+                            accepted = user_input.split(" ")[0].lower() == "accept"
+                            print("Accepting file" if accepted else "Refusing file")
+                            reactor.callFromThread(decisions.decide, "file", accepted, decision_number(user_input))
+                        elif user_input.split(" ")[0].lower() in ("accept", "refuse") and decisions.waiting("connect"):
+                            # Another peer connecting while in this chat, it goes into the pool
+                            accepted = user_input.split(" ")[0].lower() == "accept"
+                            print("Accepting connection" if accepted else "Refusing connection")
+                            reactor.callFromThread(decisions.decide, "connect", accepted, decision_number(user_input))
+                        reactor.callFromThread(peer_protocol.send_line, user_input)
                     except:
                         print("Peer connection failed")
                         program_state.connected_to_peer = False
@@ -445,74 +1094,111 @@ def input_loop(prompt_session, factory):
         logger.info("Input thread finished.")
         factory.signal_input_thread_shutdown()
 
-# Does what it says on the tin, makes ssl stuff in memory. this cant be authenticated as its just a trust-me-bro one
-class SSLFactory(ssl.ContextFactory):
-    def __init__(self):
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
-        cert = crypto.X509()
-        cert.get_subject().CN = "localhost"
-        cert.set_serial_number(1000)
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(31536000)
-        cert.set_issuer(cert.get_subject())
-        cert.set_pubkey(key)
-        cert.sign(key, "sha256")
-        self.private_key = key
-        self.certificate = cert
-
-    def getContext(self):
-        ctx = ssl.SSL.Context(ssl.SSL.TLSv1_2_METHOD)
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore")
-            ctx.use_privatekey(self.private_key)
-            ctx.use_certificate(self.certificate)
-            ## Does not work with multiple local hosts && in memory certificates so cannot test
-            # ctx.set_verify(
-            #     SSL.VERIFY_PEER | SSL.VERIFY_CLIENT_ONCE | SSL.VERIFY_FAIL_IF_NO_PEER_CERT
-            # )
-        return ctx
-
-def main(ultrapeer, port, certificate):
-    # All this jazz needs to be initialised for stuff to work chucklenuts
-    global program_state
-    global contacts
-    global factory
-    global p2p_port
-    global p2p_factory
-    global p2p_factory_listen
-    global prompt_session
-    global keypair
-    
-    program_state = State()
+# Does what it says on the tin, ssl stuff from the identity store or made in memory. this cant be authenticated as its just a trust-me-bro one
+# One of these is shared by the listener and every connection out, see tlscontext
+class SSLFactory(tlscontext.SharedContextFactory):
+    def __init__(self, private_key=None, certificate=None):
+        if private_key is None:
+            private_key, certificate = identity.make_self_signed()
+        super().__init__(private_key, certificate)
 
-    keypair = RSA.generate(2048)
+# What the prompt does as calls that return Deferreds, for driving a leaf from a script or over the control
+# socket (see control.py) instead of from a terminal. Contacts are given by number, fingerprint or whole key
+# and anything not known yet is queried first. Only to be used on the reactor thread
+class LeafClient:
+    METHODS = ("identity", "query", "contacts", "connect", "send", "peers", "close", "files", "accept")
 
-    contacts = Contacts()
+    def identity(self):
+        public_key = f"{keypair.public_key().export_key()}"
+        return {"public_key": public_key, "fingerprint": pubkeys.fingerprint(public_key).hex(), "port": p2p_port}
 
-    factory = LeafFactory()
+    def query(self, query):
+        client = factory.client_instance
+        if client is None or not client.connection_ready_event.is_set():
+            return defer.fail(ConnectionError("Not connected to the ultrapeer"))
+        return client.query(query)
 
+    def contacts(self):
+        with contacts.lock:
+            contacts.load()
+            return [contacts.find(number) for number in sorted(contacts.by_number)]
+
+    def resolve(self, contact):
+        found = contacts.find(contact)
+        if found is not None:
+            return defer.succeed(found)
+        return self.query(str(contact))
+
+    # The pooled connection to a contact, opened if there is not one already
+    def peer(self, contact):
+        return self.resolve(contact).addCallback(lambda found: peer_pool.connect(found["public_key"], found["ip"], found["port"]))
+
+    def connect(self, contact):
+        return self.peer(contact).addCallback(lambda protocol: {"fingerprint": protocol.key_fingerprint})
+
+    # Fires once the file has gone or been refused
+    def send(self, contact, path, streams=1):
+        if not os.path.isfile(path):
+            return defer.fail(FileNotFoundError(f"File not found at: {path}"))
+        d = self.peer(contact)
+        d.addCallback(lambda protocol: protocol.offer_file(path, max(1, int(streams))))
+        d.addCallback(lambda digest: {"file": path, "accepted": digest is not None, "digest": digest})
+        return d
+
+    def peers(self):
+        now = time.monotonic()
+        return [{"fingerprint": key_fingerprint, "idle": now - protocol.last_used, "busy": protocol.busy()} for key_fingerprint, protocol in peer_pool.peers.items()]
+
+    def close(self, contact):
+        found = contacts.find(contact)
+        protocol = peer_pool.peers.get(pubkeys.fingerprint(found["public_key"]).hex() if found is not None else contact)
+        if protocol is None:
+            return False
+        protocol.transport.loseConnection()
+        return True
+
+    # Files received, newest last
+    def files(self):
+        return list(program_state.transfers.finished)
+
+    # Changes what incoming connections and files get, None leaves that one as it is
+    def accept(self, connections=None, files=None):
+        if not isinstance(decisions, AutoDecisions):
+            raise ValueError("Decisions are made at the prompt")
+        for kind, answer in (("connect", connections), ("file", files)):
+            if answer is not None:
+                decisions.answers[kind] = bool(answer)
+        return {"connections": decisions.answers["connect"], "files": decisions.answers["file"]}
+
+def identity_loaded(loaded):
+    global keypair
+    global p2p_port
+    global p2p_factory_listen
+    keypair = loaded
     p2p_port = hash_string_to_port_range((f"{keypair.public_key().export_key()}".encode('utf-8')).decode('utf-8'))
     p2p_factory_listen = CommunicationClientFactory(keypair.public_key().export_key())
-    if certificate == "":
-        ssl_factory = SSLFactory()
-    else:
-        try:
-            ssl_factory = cert_options = ssl.CertificateOptions(
-                privateKey=(certificate+"cert.crt").encode('ascii'),
-                certificate=(certificate+"key.key").encode('ascii'),
-                verify=True # Genuinely it only needs verification if actual keys and certs are being used
-            )
-            pass
-        except:
-            print(f"Invalid SSL certificate directory {certificate}\nPlease make sure it contains both `cert.crt` and `key.key` and that they are a valid SSL certificate and key")
-            os._exit(1)
+    return keypair
+
+def tls_loaded(context_factory, ultrapeer, port):
+    global ssl_factory
+    ssl_factory = context_factory
+    reactor.connectSSL(ultrapeer, port, factory, tlscontext.client_creator(ssl_factory, ultrapeer, port)) # Reconnects resume the session
+    logger.info(f"Connecting to ultrapeer {ultrapeer}:{port} (SSL).")
+    tlscontext.log_on_shutdown(reactor, ssl_factory)
+    return ssl_factory
+
+def listen_for_peers(_):
     reactor.listenSSL(p2p_port, p2p_factory_listen, ssl_factory, interface="0.0.0.0")
     logger.info(f"Listening for P2P connections on port {p2p_port} (SSL).")
 
-    reactor.connectSSL(ultrapeer, port, factory, ssl_factory)
-    logger.info(f"Connecting to ultrapeer {ultrapeer}:{port} (SSL).")
+def failed_to_start(failure):
+    logger.critical(f"Failed to start the leaf: {failure.getErrorMessage()}")
+    factory.signal_input_thread_shutdown()
+    reactor.callWhenRunning(reactor.stop)
 
+# The prompt runs on its own thread while the reactor runs here
+def run_prompt():
+    global prompt_session
     prompt_session = PromptSession()
 
     input_d = threads.deferToThread(input_loop, prompt_session, factory)
@@ -535,6 +1221,65 @@ def main(ultrapeer, port, certificate):
         logger.info("Reactor stopped.")
         factory.signal_input_thread_shutdown()
 
+def main(ultrapeer, port, certificate, state_dir=STATE_DIR, headless=False, control_path=None, accept="all"):
+    # All this jazz needs to be initialised for stuff to work chucklenuts
+    global program_state
+    global contacts
+    global factory
+    global peer_pool
+    global decisions
+    global identity_ready
+    global started_at
+    
+    started_at = time.perf_counter()
+    program_state = State()
+
+    decisions = AutoDecisions(*ACCEPT_POLICIES[accept]) if headless else PendingDecisions()
+
+    peer_pool = PeerPool()
+
+    contacts = Contacts(os.path.join(state_dir, "contacts.jsonl"))
+
+    factory = LeafFactory()
+
+    # Same identity every run, only the first one pays for generating keys. The identity and the TLS key
+    # are loaded or made at the same time off the reactor thread, the ultrapeer is connected to as soon
+    # as the TLS key is there and registered with once the identity is too
+    os.makedirs(state_dir, exist_ok=True)
+    store = identity.IdentityStore(state_dir)
+    identity_ready = threads.deferToThread(store.load_identity).addCallback(identity_loaded)
+    if certificate == "":
+        tls_ready = threads.deferToThread(store.load_tls).addCallback(lambda tls: SSLFactory(*tls))
+    else:
+        try:
+            tls_ready = defer.succeed(ssl.CertificateOptions(
+                privateKey=(certificate+"cert.crt").encode('ascii'),
+                certificate=(certificate+"key.key").encode('ascii'),
+                verify=True # Genuinely it only needs verification if actual keys and certs are being used
+            ))
+            pass
+        except:
+            print(f"Invalid SSL certificate directory {certificate}\nPlease make sure it contains both `cert.crt` and `key.key` and that they are a valid SSL certificate and key")
+            os._exit(1)
+    tls_ready.addCallback(tls_loaded, ultrapeer, port)
+    keys_ready = defer.gatherResults([identity_ready, tls_ready], consumeErrors=True)
+    keys_ready.addCallback(listen_for_peers)
+    if headless: # Commands come over a unix socket instead of the prompt, see control.py
+        control_path = control_path or os.path.join(state_dir, "control.sock")
+        keys_ready.addCallback(lambda _: control.listen(control_path, LeafClient()))
+        keys_ready.addCallback(lambda _: print(f"Running without a prompt, control socket at {control_path}"))
+    keys_ready.addErrback(failed_to_start)
+
+    watchdog.ReactorWatchdog(reactor).start()
+    peer_pool.start()
+    task.LoopingCall(lambda: contacts.poll_contacts(factory.client_instance)).start(CONTACT_POLL_INTERVAL, now=False)
+
+    if headless:
+        reactor.run()
+        logger.info("Reactor stopped.")
+    else:
+        run_prompt()
+
     logger.info("Application exiting.")
     
 # Main function handling commandline arguments specifying the ultrapeer to join
@@ -549,9 +1294,18 @@ if __name__ == "__main__":
                         help="Server port number (default: 9999)")
     parser.add_argument("-C", "--certificate", dest="certificate", type=str, default="",
                         help="Directory containing certificate `cert.crt` and key `key.key`")
+    parser.add_argument("--state-dir", dest="state_dir", type=str, default=STATE_DIR,
+                        help=f"Directory the identity and contacts are kept in, one per leaf (default: {STATE_DIR})")
+    parser.add_argument("--headless", dest="headless", action="store_true",
+                        help="No prompt, take commands over the control socket instead, see control.py")
+    parser.add_argument("--control", dest="control_path", type=str, default=None,
+                        help="Unix socket for commands with --headless (default: control.sock in the state directory)")
+    parser.add_argument("--accept", dest="accept", choices=list(ACCEPT_POLICIES), default="all",
+                        help="What incoming connections and files get with --headless (default: all)")
     args = parser.parse_args()
     
     ultrapeer = args.ultrapeer
     port = args.port
     certificate = args.certificate
-    main(ultrapeer, port, certificate)
\ No newline at end of file
+    state_dir = args.state_dir
+    main(ultrapeer, port, certificate, state_dir, args.headless, args.control_path, args.accept)
\ No newline at end of file
@@ -0,0 +1,52 @@
+import base64
+import binascii
+import hashlib
+
+# Leaves pass their key around as the str() of RSA export_key(), so `b'-----BEGIN PUBLIC KEY-----\n...'`
+# with the newlines escaped. These turn that into something smaller to keep and key things by
+PEM_HEADER = "-----BEGIN PUBLIC KEY-----"
+PEM_FOOTER = "-----END PUBLIC KEY-----"
+FINGERPRINT_HEX_LENGTH = 64
+
+def to_der(public_key):
+    start = public_key.find(PEM_HEADER)
+    end = public_key.find(PEM_FOOTER)
+    if start == -1 or end < start:
+        return None
+    body = public_key[start + len(PEM_HEADER):end].replace("\\n", "").replace("\n", "")
+    try:
+        return base64.b64decode(body, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+# Back to exactly the text the leaf sent
+def to_text(der):
+    body = base64.b64encode(der)
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return str(b"\n".join([PEM_HEADER.encode('ascii'), *lines, PEM_FOOTER.encode('ascii')]))
+
+# sha256 of the DER key, 32 bytes no matter how the key was written out
+def fingerprint(public_key):
+    der = to_der(public_key)
+    return hashlib.sha256(der if der is not None else public_key.encode('utf-8')).digest()
+
+def is_fingerprint(text):
+    return len(text) == FINGERPRINT_HEX_LENGTH and all(c in "0123456789abcdefABCDEF" for c in text)
+
+# Fingerprints are kept and looked up in lowercase whatever case they were typed in
+def normalize(query):
+    return query.lower() if is_fingerprint(query) else query
+
+# Queries name a leaf by its whole key or the hex of its fingerprint
+def query_fingerprint(query):
+    return bytes.fromhex(query) if is_fingerprint(query) else fingerprint(query)
+
+# DER is ~40% smaller than the PEM text, anything that does not survive the round trip is kept as it came
+def pack(public_key):
+    der = to_der(public_key)
+    if der is not None and to_text(der) == public_key:
+        return der
+    return public_key
+
+def unpack(packed):
+    return to_text(packed) if isinstance(packed, bytes) else packed
@@ -16,9 +16,23 @@ if __name__ == "__main__":
     parser.add_argument("-UP", "--ultrapeer-port", dest="uport", type=int, default=4443,
                         help="Server port number (default: 4443)")
     parser.add_argument("-J", "--join", dest="join", default=False,
-                        help="Should the ultrapeer specified be joined (default: False)")
+                        help="Should the ultrapeer specified be joined, leaves are copied one hop and queries forwarded further (default: False)")
     parser.add_argument("-F", "--forest-port", dest="fport", type=int, default=4444,
                         help="Port number to use for syncing with the forst (default: 4444)")
+    parser.add_argument("--forest-flush", dest="flush_window", type=float, default=0.05,
+                        help="Seconds to batch forest changes for before sending them to other ultrapeers, 0 sends each at once (default: 0.05)")
+    parser.add_argument("--no-replica", dest="replicate", action="store_false",
+                        help="Ultrapeer only, do not keep a copy of the other ultrapeers leaves, queries that miss are forwarded to them instead")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Ultrapeer only, processes sharing the client port, each with its own forest on the ports after --forest-port (default: 1)")
+    parser.add_argument("--state-dir", dest="state_dir", type=str, default=l.STATE_DIR,
+                        help=f"Leaf only, directory the identity and contacts are kept in, one per leaf (default: {l.STATE_DIR})")
+    parser.add_argument("--headless", dest="headless", action="store_true",
+                        help="Leaf only, no prompt, take commands over the control socket instead, see control.py")
+    parser.add_argument("--control", dest="control_path", type=str, default=None,
+                        help="Leaf only, unix socket for commands with --headless (default: control.sock in the state directory)")
+    parser.add_argument("--accept", dest="accept", choices=list(l.ACCEPT_POLICIES), default="all",
+                        help="Leaf only, what incoming connections and files get with --headless (default: all)")
     parser.add_argument("-M", "--mode", dest="mode", default="leaf",
                         help="which mode to run in `leaf` or `ultrapeer` (default: leaf)")
     args = parser.parse_args()
@@ -30,10 +44,17 @@ if __name__ == "__main__":
     fport = args.fport
     certificate = args.certificate
     mode = args.mode
+    flush_window = args.flush_window
+    replicate = args.replicate
+    state_dir = args.state_dir
+    workers = args.workers
+    headless = args.headless
+    control_path = args.control_path
+    accept = args.accept
     
     if mode == "leaf":
-        l.main(ultrapeer, port, certificate)
+        l.main(ultrapeer, port, certificate, state_dir, headless, control_path, accept)
     elif mode == "ultrapeer":
-        up.main(ultrapeer, uport, join, port, fport, certificate)
+        up.main(ultrapeer, uport, join, port, fport, certificate, flush_window, replicate, workers)
     else:
         parser.print_help()
\ No newline at end of file
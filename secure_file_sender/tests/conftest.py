@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The modules import each other by name, the same as when run from secure_file_sender
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# leaf and ultrapeer start logging to ./logs as soon as they are imported, that goes somewhere throwaway
+os.chdir(tempfile.mkdtemp(prefix="sfs-tests-"))
+os.makedirs("logs")
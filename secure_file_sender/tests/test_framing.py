@@ -0,0 +1,50 @@
+import random
+import pytest
+import framing
+
+class Recorder(framing.FramedProtocol):
+    def __init__(self):
+        self.frames = []
+
+    def frame_received(self, frame_type, payload):
+        self.frames.append((frame_type, payload))
+
+def packed_frames(seed=0):
+    rng = random.Random(seed)
+    frames = [(framing.TEXT, b""), (framing.KEEPALIVE, b""), (framing.QUERY, "zażółć||¬".encode("utf-8"))]
+    frames += [(rng.choice((framing.TEXT, framing.FILE_CHUNK, framing.STREAM)), rng.randbytes(rng.choice((1, 4, 5, 6, 300, 70000)))) for _ in range(40)]
+    return frames, b"".join(framing.pack(frame_type, payload) for frame_type, payload in frames)
+
+def coalesced(wire):
+    return [wire]
+
+def byte_by_byte(wire):
+    return [wire[i:i + 1] for i in range(len(wire))]
+
+def random_splits(wire):
+    cuts = sorted(random.Random(1).sample(range(1, len(wire)), 200))
+    return [wire[start:end] for start, end in zip([0] + cuts, cuts + [len(wire)])]
+
+# TCP can split a frame over any number of reads or put several in one, both have to give back what was sent
+@pytest.mark.parametrize("reads", [coalesced, byte_by_byte, random_splits])
+def test_split_and_coalesced_reads(reads):
+    frames, wire = packed_frames()
+    recorder = Recorder()
+    for data in reads(wire):
+        recorder.dataReceived(data)
+    assert recorder.frames == frames
+    assert not recorder._buffer
+
+class Transport:
+    def __init__(self):
+        self.closed = False
+
+    def loseConnection(self):
+        self.closed = True
+
+def test_oversized_frame_drops_connection():
+    recorder = Recorder()
+    recorder.transport = Transport()
+    recorder.dataReceived(framing.HEADER.pack(framing.TEXT, framing.FramedProtocol.MAX_LENGTH + 1))
+    assert recorder.transport.closed
+    assert recorder.frames == []
@@ -0,0 +1,149 @@
+import json
+import os
+import pytest
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+import framing
+import pubkeys
+import leaf
+import transfer
+
+# The globals leaf.main would set up, without an identity, an ultrapeer or a reactor running
+@pytest.fixture(autouse=True)
+def leaf_state(monkeypatch):
+    monkeypatch.setattr(leaf, "program_state", leaf.State(), raising=False)
+    monkeypatch.setattr(leaf, "decisions", leaf.AutoDecisions(), raising=False)
+    monkeypatch.setattr(leaf, "peer_pool", leaf.PeerPool(), raising=False)
+    monkeypatch.setattr(leaf, "contacts", leaf.Contacts(), raising=False)
+
+class Transport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def loseConnection(self):
+        self.closed = True
+
+def connect(factory):
+    protocol = factory.buildProtocol(None)
+    protocol.transport = Transport()
+    return protocol
+
+def close(protocol):
+    protocol.connectionLost(Failure(ConnectionDone()))
+
+# Every past incoming connection used to stay reachable from the listening factory through replaced_protocol
+def test_incoming_connections_do_not_chain():
+    factory = leaf.CommunicationClientFactory("me")
+    chat = connect(factory)
+    stream = connect(factory)
+    assert stream.replaced_protocol is chat
+    leaf.program_state.transfers.incoming["abc"] = manifest = object()
+    stream.frame_received(framing.STREAM, b"abc")
+    assert stream.recieve_transfer is manifest
+    assert stream.replaced_protocol is None
+    assert factory.peer_protocol is chat
+    later = connect(factory)
+    close(later)
+    assert later.replaced_protocol is None
+
+def test_outgoing_connections_keep_no_replaced_protocol():
+    factory = leaf.CommunicationClientFactory("them")
+    factory.peer_address = ("127.0.0.1", 5000)
+    connect(factory)
+    assert connect(factory).replaced_protocol is None
+
+KEY = "b'-----BEGIN PUBLIC KEY-----\\nMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEAtnSKxCavfd7spSEXbmSp\\n-----END PUBLIC KEY-----'"
+
+# The ultrapeer takes fingerprints in either case, the contact has to be found again whichever was typed
+def test_uppercase_fingerprint_contact_is_finalized():
+    contacts = leaf.Contacts()
+    contacts.initialize_contact(pubkeys.fingerprint(KEY).hex().upper())
+    assert contacts.finalize_contact([KEY, "10.0.0.1", "5000"])
+    assert contacts.find(0)["public_key"] == KEY
+    assert contacts.find(pubkeys.fingerprint(KEY).hex().upper())["number"] == 0
+
+def test_uppercase_fingerprint_query_fires():
+    protocol = leaf.LeafProtocol(None)
+    protocol.transport = Transport()
+    found = []
+    protocol.query(pubkeys.fingerprint(KEY).hex().upper()).addCallback(found.append)
+    protocol.frame_received(framing.RESPONSE, f"{KEY}||¬10.0.0.1||¬5000".encode("utf-8"))
+    assert found[0]["public_key"] == KEY
+    assert found[0]["port"] == 5000
+
+class PeerTransport(Transport):
+    def __bool__(self):
+        return not self.closed
+
+def pooled_peer(i):
+    protocol = leaf.CommunicationProtocol()
+    protocol.transport = PeerTransport()
+    leaf.peer_pool.add(f"peer-{i}", protocol)
+    return protocol
+
+# Under the limit nothing gets closed, past it only the least recently used idle ones go
+def test_pool_keeps_peers_under_the_limit():
+    peers = [pooled_peer(i) for i in range(20)]
+    assert not any(peer.transport.closed for peer in peers)
+    assert len(leaf.peer_pool.peers) == 20
+
+def test_pool_closes_least_recently_used_over_the_limit(monkeypatch):
+    monkeypatch.setattr(leaf, "MAX_PEERS", 4)
+    peers = [pooled_peer(i) for i in range(6)]
+    assert [peer.transport.closed for peer in peers] == [False, True, True, False, False, False]
+
+# Files offered over a pooled connection while nobody is in the chat are answered from the outer prompt
+def test_decision_kind_finds_waiting_file(monkeypatch):
+    monkeypatch.setattr(leaf.reactor, "callLater", lambda *args: type("Call", (), {"cancel": lambda self: None})())
+    monkeypatch.setattr(leaf, "decisions", leaf.PendingDecisions())
+    leaf.decisions.ask("file", None, "Peer is attempting to send file a.bin")
+    assert leaf.decision_kind("accept") == "file"
+    leaf.decisions.ask("connect", None, "Peer requesting to connect")
+    assert leaf.decision_kind("refuse") == "connect"
+    assert leaf.decision_kind("accept 1") == "file"
+    assert leaf.decision_kind("accept 7") is None
+
+def offered(protocol, path):
+    with open(path, "wb") as f:
+        f.write(b"x" * 1000)
+    offer = leaf.program_state.transfers.offer(path, 1, 256, protocol)
+    failures = []
+    offer.done.addErrback(failures.append)
+    return offer, failures
+
+def frames(transport):
+    return [(framing.HEADER.unpack_from(data)[0], data[framing.HEADER.size:].decode("utf-8")) for data in transport.written]
+
+# Whatever waits on an offer (LeafClient.send over the control socket) has to hear back even if the send cannot start
+def test_accept_for_missing_file_fails_the_offer():
+    protocol = connect(leaf.CommunicationClientFactory("them"))
+    offer, failures = offered(protocol, "gone.bin")
+    os.remove("gone.bin")
+    protocol.frame_received(framing.FILE_ACCEPT, json.dumps({"id": "t1", "ranges": [[0, 1000]], "codec": None, "offer": offer.offer_id}).encode("utf-8"))
+    assert failures[0].check(FileNotFoundError)
+    assert frames(protocol.transport) == [(framing.FILE_REFUSE, "t1||¬nie da się wysłać")]
+    assert leaf.program_state.transfers.offers == {}
+
+def test_malformed_accept_closes_the_connection():
+    protocol = connect(leaf.CommunicationClientFactory("them"))
+    offer, failures = offered(protocol, "kept.bin")
+    protocol.frame_received(framing.FILE_ACCEPT, b"[1, 2")
+    assert protocol.transport.closed
+    close(protocol)
+    assert failures[0].check(ConnectionError)
+
+def test_refused_accepted_transfer_is_dropped():
+    protocol = connect(leaf.CommunicationClientFactory("me"))
+    manifest = transfer.TransferManifest("incoming.bin", 1000, 256)
+    manifest.open()
+    manifest.transfer_id = "t2"
+    leaf.program_state.transfers.incoming["t2"] = manifest
+    protocol.accepted.append(manifest)
+    protocol.frame_received(framing.FILE_REFUSE, "t2||¬nie da się wysłać".encode("utf-8"))
+    assert protocol.accepted == []
+    assert leaf.program_state.transfers.incoming == {}
+    assert manifest.part_file is None
@@ -0,0 +1,79 @@
+import json
+import pytest
+import framing
+import pubkeys
+import ultrapeer
+
+DETAILS = {"ip": "10.0.0.1", "port": 5000, "rport": 40000}
+
+@pytest.fixture
+def forest(monkeypatch):
+    forest = ultrapeer.Forest()
+    monkeypatch.setattr(ultrapeer, "forest", forest, raising=False)
+    return forest
+
+# Two other trees joined to this one, both past their snapshots
+@pytest.fixture
+def trees(forest):
+    factory = ultrapeer.ForestFactory(0)
+    trees = [ultrapeer.ForestProtocol(factory) for _ in range(2)]
+    for tree in trees:
+        tree.last_seq = 0
+        factory.trees.append(tree)
+    return trees
+
+def delta(tree, *changes):
+    tree.frame_received(framing.FOREST_DELTA, json.dumps({"seq": tree.last_seq + 1, "changes": list(changes)}).encode("utf-8"))
+
+def add(key):
+    return {"op": "add", "fingerprint": pubkeys.fingerprint(key).hex(), "key": key, "value": DETAILS}
+
+def remove(key):
+    return {"op": "remove", "fingerprint": pubkeys.fingerprint(key).hex()}
+
+def test_other_tree_cannot_remove_local_leaf(forest):
+    transport = object()
+    forest.set("leaf", DETAILS, transport)
+    known_keys = set()
+    forest.apply_changes([add("leaf"), remove("leaf")], known_keys)
+    forest.from_serialized(json.dumps({"seq": 1, "forest": {}}), known_keys | {pubkeys.fingerprint("leaf")})
+    assert pubkeys.fingerprint("leaf") in forest.forest
+    assert forest.by_transport == {transport: {pubkeys.fingerprint("leaf")}}
+    assert known_keys == set()
+
+# A leaf that moved from one tree to another before the first noticed it leave
+def test_late_remove_keeps_leaf_another_tree_holds(forest, trees):
+    first, second = trees
+    delta(first, add("leaf"))
+    delta(second, add("leaf"))
+    delta(first, remove("leaf"))
+    assert pubkeys.fingerprint("leaf") in forest.forest
+    delta(second, remove("leaf"))
+    assert pubkeys.fingerprint("leaf") not in forest.forest
+
+def test_snapshot_keeps_leaf_another_tree_holds(forest, trees):
+    first, second = trees
+    delta(first, add("leaf"), add("gone"))
+    delta(second, add("leaf"))
+    first.frame_received(framing.FOREST, json.dumps({"seq": 5, "forest": {}}).encode("utf-8"))
+    assert pubkeys.fingerprint("leaf") in forest.forest
+    assert pubkeys.fingerprint("gone") not in forest.forest
+    assert first.known_keys == set()
+
+class Transport:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+# Deltas only go one hop, a tree further along the chain finds the leaf by asking this one
+def test_leaf_from_one_tree_is_answered_to_another(forest, trees):
+    first, second = trees
+    second.transport = Transport()
+    delta(first, add("leaf"))
+    second.frame_received(framing.FOREST_QUERY, json.dumps({"id": "q", "ttl": 3, "query": pubkeys.fingerprint("leaf").hex()}).encode("utf-8"))
+    frame_type, length = framing.HEADER.unpack_from(second.transport.written[-1])
+    answer = json.loads(second.transport.written[-1][framing.HEADER.size:])
+    assert frame_type == framing.FOREST_ANSWER
+    assert answer == {"id": "q", "found": ["leaf", DETAILS["ip"], DETAILS["port"]]}
@@ -0,0 +1,117 @@
+import logging
+import time
+import warnings
+import weakref
+from collections import OrderedDict
+from OpenSSL import SSL
+from twisted.internet import ssl
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator, IOpenSSLServerConnectionCreator
+from zope.interface import implementer
+
+logger = logging.getLogger(__name__)
+
+# Handshake timings, a reconnect storm shows up here as lots of full handshakes
+class HandshakeStats:
+    def __init__(self):
+        self.started = weakref.WeakKeyDictionary() # connection -> [wall, reactor thread cpu, saw a certificate] at start
+        self.clients = weakref.WeakSet() # Only the client side can tell a resumed handshake from a full one
+        self.handshakes = 0
+        self.resumed = 0
+        self.latency = 0.0
+        self.cpu_time = 0.0
+
+    def info(self, connection, where, _ret):
+        if where & SSL.SSL_CB_HANDSHAKE_START:
+            self.started[connection] = [time.perf_counter(), time.thread_time(), False]
+        elif where & SSL.SSL_CB_CONNECT_LOOP and connection in self.started:
+            # A resumed handshake skips the servers certificate and so the RSA verify that goes with it
+            if connection.get_state_string() == b"SSLv3/TLS read server certificate":
+                self.started[connection][2] = True
+        elif where & SSL.SSL_CB_HANDSHAKE_DONE and connection in self.started:
+            wall, cpu, full = self.started.pop(connection)
+            self.handshakes += 1
+            self.latency += time.perf_counter() - wall
+            self.cpu_time += time.thread_time() - cpu
+            if connection in self.clients and not full:
+                self.resumed += 1
+
+    def stats(self):
+        average = self.latency / self.handshakes * 1000 if self.handshakes else 0.0
+        return f"{self.handshakes} handshakes, {self.resumed} resumed, average {average:.1f}ms, cpu {self.cpu_time:.3f}s"
+
+# One TLS context built once and shared by every listener and connection. It allows TLS 1.3 and resumes
+# sessions both ways: tickets for 1.3 and the session id cache for 1.2. That way a reconnect to a
+# peer or ultrapeer skips the RSA part of the handshake
+@implementer(IOpenSSLServerConnectionCreator)
+class SharedContextFactory(ssl.ContextFactory):
+    SESSIONS = 1024 # Servers remembered for resuming on the client side
+
+    def __init__(self, private_key, certificate):
+        self.private_key = private_key
+        self.certificate = certificate
+        self.context = None
+        self.sessions = OrderedDict() # (host, port) -> last connection made to it
+        self.handshake_stats = HandshakeStats()
+
+    def getContext(self):
+        if self.context is None:
+            self.context = self.build_context()
+        return self.context
+
+    def build_context(self):
+        ctx = SSL.Context(SSL.TLS_METHOD)
+        ctx.set_min_proto_version(SSL.TLS1_2_VERSION)
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore")
+            ctx.use_privatekey(self.private_key)
+            ctx.use_certificate(self.certificate)
+            ## Does not work with multiple local hosts && in memory certificates so cannot test
+            # ctx.set_verify(
+            #     SSL.VERIFY_PEER | SSL.VERIFY_CLIENT_ONCE | SSL.VERIFY_FAIL_IF_NO_PEER_CERT
+            # )
+        ctx.set_session_id(b"secure_file_sender")
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_BOTH)
+        ctx.set_info_callback(self.handshake_stats.info)
+        return ctx
+
+    def serverConnectionForTLS(self, tlsProtocol):
+        return SSL.Connection(self.getContext(), None)
+
+    # What to hand connectSSL, connections made through it pick up the last session with that server
+    def client_for(self, host, port):
+        return ClientConnectionCreator(self, (host, port))
+
+    def client_connection(self, server):
+        connection = SSL.Connection(self.getContext(), None)
+        self.handshake_stats.clients.add(connection)
+        previous = self.sessions.pop(server, None)
+        if previous is not None:
+            # Tickets arrive after the handshake so this is read as late as possible. If that connection
+            # dropped without a TLS shutdown OpenSSL refuses to resume it and this is a full handshake again
+            session = previous.get_session()
+            if session is not None:
+                connection.set_session(session)
+        self.sessions[server] = connection
+        while len(self.sessions) > self.SESSIONS:
+            self.sessions.popitem(last=False)
+        return connection
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ClientConnectionCreator:
+    def __init__(self, factory, server):
+        self.factory = factory
+        self.server = server
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        return self.factory.client_connection(self.server)
+
+# Certificates given on the command line come as plain CertificateOptions which do their own thing
+def client_creator(context_factory, host, port):
+    if isinstance(context_factory, SharedContextFactory):
+        return context_factory.client_for(host, port)
+    return context_factory
+
+# Handshake stats go in the log when the reactor stops
+def log_on_shutdown(reactor, context_factory):
+    if isinstance(context_factory, SharedContextFactory):
+        reactor.addSystemEventTrigger("before", "shutdown", lambda: logger.info(f"TLS: {context_factory.handshake_stats.stats()}"))
@@ -0,0 +1,372 @@
+import hashlib
+import logging
+import mmap
+import os
+import secrets
+import struct
+from collections import deque
+from twisted.internet import defer, interfaces, threads
+from zope.interface import implementer
+import compression
+import framing
+
+logger = logging.getLogger(__name__)
+
+# Every FILE_CHUNK payload starts with the byte offset of the chunk in the file, the sha256 of its
+# uncompressed data and the compression flag
+CHUNK_HEADER = struct.Struct("!Q32sB")
+NO_DIGEST = bytes(32)
+MAX_CHUNK_SIZE = framing.FramedProtocol.MAX_LENGTH - CHUNK_HEADER.size # Biggest chunk that still fits in one frame
+FINISHED = 1000 # Received files remembered in TransferTable.finished
+
+def pack_chunk(offset, data, digest=NO_DIGEST, flag=compression.RAW):
+    return chunk_header(offset, len(data), digest, flag) + data
+
+# Frame header plus the chunk header, for when the data itself goes to the transport separately
+def chunk_header(offset, length, digest, flag):
+    return framing.HEADER.pack(framing.FILE_CHUNK, CHUNK_HEADER.size + length) + CHUNK_HEADER.pack(offset, digest, flag)
+
+# Offers come from the other peer so the sizes are checked before anything gets allocated for them
+def valid_offer(file_size, chunk_size):
+    return file_size >= 0 and 0 < chunk_size <= MAX_CHUNK_SIZE
+
+def unpack_chunk(payload):
+    offset, digest, flag = CHUNK_HEADER.unpack_from(payload)
+    return offset, digest, flag, payload[CHUNK_HEADER.size:]
+
+# The whole file digest is the sha256 of every chunk digest in order, so it can be built from chunks
+# hashed as they stream past, in any order and over any number of connections
+def file_digest(chunk_digests, chunk_count):
+    return hashlib.sha256(b"".join(chunk_digests[index] for index in range(chunk_count))).hexdigest()
+
+# Hashes the chunks in the given ranges, meant for a worker thread
+def hash_ranges(filepath, ranges, chunk_size):
+    digests = {}
+    with open(filepath, "rb") as f:
+        for start, end in ranges:
+            f.seek(start)
+            while start < end:
+                data = f.read(min(chunk_size, end - start))
+                if not data:
+                    raise ValueError(f"{filepath} ended early at {start}")
+                digests[start // chunk_size] = hashlib.sha256(data).digest()
+                start += len(data)
+    return digests
+
+# Byte ranges of a file of `size` not covered by `ranges`
+def other_ranges(ranges, size):
+    result = []
+    position = 0
+    for start, end in sorted(ranges):
+        if start > position:
+            result.append([position, start])
+        position = max(position, end)
+    if position < size:
+        result.append([position, size])
+    return result
+
+# Keeps track of which chunks of a file have arrived so a dropped transfer can pick up where it left off
+# Lives next to the partial file as `<name>.manifest`, the first line is `<size> <chunk size>`
+# and then a `<chunk index> <sha256>` line gets appended for every chunk written to `<name>.part`
+class TransferManifest:
+    def __init__(self, filepath, size, chunk_size):
+        self.filepath = filepath
+        self.part_path = f"{filepath}.part"
+        self.manifest_path = f"{filepath}.manifest"
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunk_count = -(-size // chunk_size)
+        self.chunks = {}
+        self.part_file = None
+        self.manifest_file = None
+        self.transfer_id = None
+        self.streams = 0 # Connections still writing into this file
+        self.pending = set() # Chunk writes still out on worker threads
+        self.expected_digest = None
+        self.rejected = 0
+        self.decompressor = compression.DecompressStats(None)
+
+    def load(self):
+        if not (os.path.exists(self.manifest_path) and os.path.exists(self.part_path)):
+            return False
+        with open(self.manifest_path, "r") as f:
+            header = f.readline().split()
+            if header != [str(self.size), str(self.chunk_size)]: # Different file or chunking, start over
+                logger.info(f"Discarding stale manifest {self.manifest_path}")
+                return False
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2: # Half written line from a crash, that chunk just gets sent again
+                    continue
+                self.chunks[int(parts[0])] = parts[1]
+        return True
+
+    def open(self):
+        resumed = self.load()
+        if not resumed:
+            self.chunks = {}
+            with open(self.part_path, "wb"):
+                pass
+            with open(self.manifest_path, "w") as f:
+                f.write(f"{self.size} {self.chunk_size}\n")
+        self.part_file = open(self.part_path, "r+b")
+        self.part_file.truncate(self.size) # Preallocate so every stream can write straight to its offset
+        self.manifest_file = open(self.manifest_path, "a")
+        return resumed
+
+    def received_bytes(self):
+        return sum(min(self.chunk_size, self.size - index * self.chunk_size) for index in self.chunks)
+
+    # Coalesces the missing chunks into [start, end) byte ranges
+    def missing_ranges(self):
+        ranges = []
+        for index in range(self.chunk_count):
+            if index in self.chunks:
+                continue
+            start = index * self.chunk_size
+            end = min(start + self.chunk_size, self.size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    def check_chunk(self, offset):
+        index, remainder = divmod(offset, self.chunk_size)
+        if remainder or index >= self.chunk_count:
+            raise ValueError(f"Chunk at offset {offset} does not fit {self.filepath}")
+        return index
+
+    # Runs on a worker thread so decompressing, hashing and disk writes never hold up the reactor
+    def store_chunk(self, offset, data, flag):
+        length = min(self.chunk_size, self.size - offset)
+        data = self.decompressor.decompress(flag, data, length)
+        if len(data) != length:
+            raise ValueError(f"Chunk at offset {offset} of {len(data)} bytes does not fit {self.filepath}")
+        os.pwrite(self.part_file.fileno(), data, offset) # Unbuffered so the data is down before the manifest says so
+        return hashlib.sha256(data).digest()
+
+    # Back on the reactor, only chunks matching the digest the sender sent get recorded
+    # anything else stays missing and gets sent again next time
+    def record_chunk(self, index, digest, expected):
+        if digest != expected:
+            logger.warning(f"Chunk {index} of {self.filepath} failed its digest check")
+            self.rejected += 1
+            return False
+        self.manifest_file.write(f"{index} {digest.hex()}\n")
+        self.manifest_file.flush()
+        self.chunks[index] = digest.hex()
+        return True
+
+    def digest(self):
+        return file_digest({index: bytes.fromhex(digest) for index, digest in self.chunks.items()}, self.chunk_count)
+
+    def verify(self):
+        return self.is_complete() and self.expected_digest is not None and self.digest() == self.expected_digest
+
+    def is_complete(self):
+        return len(self.chunks) == self.chunk_count
+
+    def close(self):
+        for f in (self.part_file, self.manifest_file):
+            if f is not None:
+                f.close()
+        self.part_file = None
+        self.manifest_file = None
+
+    # Moves the finished file into place once its digest checks out, an incomplete one is left for the next attempt
+    # A complete file that does not match had chunks from a different version of it so it all goes
+    def finish(self):
+        self.close()
+        if not self.is_complete() or self.expected_digest is None:
+            return False
+        if not self.verify():
+            logger.error(f"{self.filepath} does not match the digest the sender sent, discarding it")
+            os.remove(self.part_path)
+            os.remove(self.manifest_path)
+            return False
+        os.replace(self.part_path, self.filepath)
+        os.remove(self.manifest_path)
+        return True
+
+# Sender side of a transfer, collects the chunk digests from every stream sending it plus
+# any chunks the receiver already had, so the whole file digest comes without a second pass
+class OutgoingTransfer:
+    def __init__(self, transfer_id, filepath, chunk_size, codec=None):
+        self.transfer_id = transfer_id
+        self.filepath = filepath
+        self.size = os.path.getsize(filepath)
+        self.chunk_size = chunk_size
+        self.chunk_count = -(-self.size // chunk_size)
+        self.digests = {}
+        self.compressor = compression.AdaptiveCompressor(codec) # Shared by every stream so they all learn when to stop
+
+    def hash_skipped(self, ranges):
+        d = threads.deferToThread(hash_ranges, self.filepath, other_ranges(ranges, self.size), self.chunk_size)
+        d.addCallback(self.digests.update)
+        return d
+
+    def digest(self):
+        return file_digest(self.digests, self.chunk_count)
+
+# A file offered to a peer, waiting on it to accept or refuse
+class Offer:
+    def __init__(self, offer_id, filepath, streams, chunk_size, owner):
+        self.offer_id = offer_id
+        self.filepath = filepath
+        self.streams = streams
+        self.chunk_size = chunk_size
+        self.owner = owner # Connection it went out on
+        self.done = defer.Deferred() # Fires with the digest once sent, None if it was refused
+
+# Every transfer going on with any peer: offers waiting on an answer, files going out and files coming in
+# Each one carries its own path and settings so any number can run at once
+class TransferTable:
+    def __init__(self):
+        self.offers = {} # offer id -> Offer
+        self.outgoing = {} # transfer id -> OutgoingTransfer
+        self.incoming = {} # transfer id -> TransferManifest
+        self.finished = deque(maxlen=FINISHED) # Files received, newest last, for whoever is driving the leaf without a prompt
+
+    def offer(self, filepath, streams, chunk_size, owner):
+        offer = Offer(secrets.token_hex(8), filepath, streams, chunk_size, owner)
+        self.offers[offer.offer_id] = offer
+        return offer
+
+    # The answer has to come back over the connection the offer went out on, one without an id is for the oldest
+    def answer(self, offer_id, owner):
+        if not offer_id:
+            offer_id = next((key for key, offer in self.offers.items() if offer.owner is owner), None)
+        offer = self.offers.get(offer_id)
+        if offer is None or offer.owner is not owner:
+            return None
+        return self.offers.pop(offer_id)
+
+    # Offers on a connection that has gone can never be answered
+    def drop(self, owner):
+        for offer_id in [key for key, offer in self.offers.items() if offer.owner is owner]:
+            self.offers.pop(offer_id).done.errback(ConnectionError("Peer disconnected before answering the offer"))
+
+    # Two peers sending a file with the same name at once each get their own copy
+    def receive_path(self, file_name):
+        receiving = {manifest.filepath for manifest in self.incoming.values()}
+        stem, extension = os.path.splitext(file_name)
+        path = file_name
+        number = 1
+        while path in receiving:
+            path = f"{stem} ({number}){extension}"
+            number += 1
+        return path
+
+# Splits chunk aligned ranges into up to `streams` groups of roughly the same number of bytes
+def split_ranges(ranges, streams, chunk_size):
+    total = sum(end - start for start, end in ranges)
+    share = max(chunk_size, -(-total // streams // chunk_size) * chunk_size)
+    groups = [[]]
+    filled = 0
+    for start, end in ranges:
+        while start < end:
+            if filled >= share:
+                groups.append([])
+                filled = 0
+            take = min(end - start, share - filled)
+            groups[-1].append([start, start + take])
+            filled += take
+            start += take
+    return groups
+
+# Like FileSender but only sends the requested byte ranges, each chunk framed with its offset
+@implementer(interfaces.IPullProducer)
+class RangeFileSender:
+    def __init__(self, file, ranges, chunk_size, digests=None, compressor=None):
+        self.file = file
+        self.ranges = [list(r) for r in ranges]
+        self.chunk_size = chunk_size
+        self.digests = {} if digests is None else digests
+        self.compressor = compression.AdaptiveCompressor(None) if compressor is None else compressor
+        self.consumer = None
+        self.deferred = None
+
+    def beginFileTransfer(self, consumer):
+        self.consumer = consumer
+        self.deferred = deferred = defer.Deferred()
+        self.consumer.registerProducer(self, False)
+        return deferred
+
+    def resumeProducing(self):
+        while self.ranges and self.ranges[0][0] >= self.ranges[0][1]:
+            self.ranges.pop(0)
+        if not self.ranges:
+            self.consumer.unregisterProducer()
+            if self.deferred:
+                self.deferred.callback(None)
+                self.deferred = None
+            return
+        current = self.ranges[0]
+        chunk = self.read(current[0], min(self.chunk_size, current[1] - current[0]))
+        if not chunk: # File shrank under us
+            self.consumer.unregisterProducer()
+            self.stopProducing()
+            return
+        digest = hashlib.sha256(chunk).digest()
+        self.digests[current[0] // self.chunk_size] = digest
+        flag, data = self.compressor.compress_chunk(chunk)
+        self.write(current[0], data, digest, flag)
+        current[0] += len(chunk)
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def write(self, offset, chunk, digest, flag):
+        self.consumer.write(pack_chunk(offset, chunk, digest, flag))
+
+    def close(self):
+        pass
+
+    def stopProducing(self):
+        if self.deferred:
+            self.deferred.errback(Exception("File ended early or consumer asked us to stop producing"))
+            self.deferred = None
+
+# Serves the chunks as memoryview slices of a read only mmap of the file, so the only copy
+# made is the one the transport does when it encrypts, instead of a read() and a frame concat per chunk
+# Touching a page past the end of a file that was truncated after it was mapped is SIGBUS, not an exception,
+# and it kills the whole leaf. The size is checked before every slice so a file that shrank (logs rotated
+# with copytruncate) fails only its own transfer, but slices already queued in the transport are read later
+# and nothing can check those, so this is opt in with `backend mmap` for files nothing else is writing to
+class MmapRangeFileSender(RangeFileSender):
+    def __init__(self, file, ranges, chunk_size, digests=None, compressor=None):
+        super().__init__(file, ranges, chunk_size, digests, compressor)
+        self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+    def read(self, offset, length):
+        if os.fstat(self.file.fileno()).st_size < offset + length: # Shrank under us, same as an empty read
+            return b""
+        return self.view[offset:offset + length]
+
+    def write(self, offset, chunk, digest, flag):
+        self.consumer.write(chunk_header(offset, len(chunk), digest, flag))
+        self.consumer.write(chunk)
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError: # Slices are still queued in the transport, the map goes once they are sent
+            pass
+
+SEND_BACKENDS = {
+    "buffered": RangeFileSender,
+    "mmap": MmapRangeFileSender,
+}
+
+# Empty files cannot be mapped so those always go the buffered way
+def make_file_sender(backend, file, ranges, chunk_size, digests=None, compressor=None):
+    if backend == "mmap" and os.fstat(file.fileno()).st_size > 0:
+        try:
+            return MmapRangeFileSender(file, ranges, chunk_size, digests, compressor)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not mmap {file.name}, falling back to buffered reads: {e}")
+    return RangeFileSender(file, ranges, chunk_size, digests, compressor)
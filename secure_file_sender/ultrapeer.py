@@ -1,40 +1,180 @@
 import argparse
 import logging
 import os
-import time
-from twisted.internet.protocol import Protocol, Factory, ReconnectingClientFactory
-from twisted.internet import reactor, ssl
+import secrets
+from collections import OrderedDict
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.internet import defer, reactor, ssl, task, threads
+from twisted.protocols.tls import TLSMemoryBIOFactory
 from OpenSSL import crypto, SSL
-import warnings
 import threading
 import hashlib
 import json
+import multiprocessing
+import signal
 import socket
+import framing
+import pubkeys
+import tlscontext
+import watchdog
 
 # Configure logging
 global logger
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    filename=f"./logs/{socket.gethostname()}.log",
-    filemode="w"
-)
+def log_to(filename, force=False):
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        filename=filename,
+        filemode="w",
+        force=force
+    )
+if not multiprocessing.current_process().name.startswith("ultrapeer-"): # Workers log to their own file, see worker
+    log_to(f"./logs/{socket.gethostname()}.log")
 logger = logging.getLogger(__name__)
 
+# What the directory keeps per leaf, slots instead of a dict per entry keeps a million of these affordable
+class LeafRecord:
+    __slots__ = ("key", "ip", "port", "rport")
+
+    def __init__(self, key, ip, port, rport):
+        self.key = key # Packed, see pubkeys.pack
+        self.ip = ip
+        self.port = int(port)
+        self.rport = rport
+
+    def to_dict(self):
+        return {"ip": self.ip, "port": self.port, "rport": self.rport}
+
+# Everything is keyed by the 32 byte sha256 fingerprint of the leafs key, the key itself is kept packed
+# in the record and only turned back into text when a reply or a snapshot needs it
 class Forest:
     def __init__(self):
-        self.forest = {}
-        
+        self.forest = {} # fingerprint -> LeafRecord
+        self.seq = 0 # Bumped for every delta sent out so other trees can tell if they missed one
+        # Indexes kept next to the forest so nothing has to scan it, only leaves registered here have a transport
+        self.by_transport = {} # transport -> fingerprints registered over it, normally just the one
+        self.transports = {} # fingerprint -> transport
+
+    def public_key(self, key_fingerprint):
+        return pubkeys.unpack(self.forest[key_fingerprint].key)
+
+    # Queries can name a leaf by its whole key or the hex of its fingerprint
+    def lookup(self, query):
+        key_fingerprint = pubkeys.query_fingerprint(query)
+        record = self.forest.get(key_fingerprint)
+        if record is None:
+            return None
+        return self.public_key(key_fingerprint), record
+
+    def index_transport(self, key_fingerprint, transport):
+        old_transport = self.transports.get(key_fingerprint)
+        if old_transport is not None and old_transport is not transport: # Reregistered from a new connection
+            self.unindex_transport(key_fingerprint, old_transport)
+        self.by_transport.setdefault(transport, set()).add(key_fingerprint)
+        self.transports[key_fingerprint] = transport
+
+    def unindex_transport(self, key_fingerprint, transport):
+        registered = self.by_transport.get(transport)
+        if registered is not None:
+            registered.discard(key_fingerprint)
+            if not registered:
+                del self.by_transport[transport]
+
+    def put(self, public_key, details, key_fingerprint=None):
+        if key_fingerprint is None:
+            key_fingerprint = pubkeys.fingerprint(public_key)
+        record = self.forest.get(key_fingerprint)
+        packed = record.key if record is not None else pubkeys.pack(public_key)
+        self.forest[key_fingerprint] = LeafRecord(packed, details["ip"], details["port"], details["rport"])
+        return key_fingerprint
+
+    def drop(self, key_fingerprint):
+        if self.forest.pop(key_fingerprint, None) is None:
+            return False
+        transport = self.transports.pop(key_fingerprint, None)
+        if transport is not None:
+            self.unindex_transport(key_fingerprint, transport)
+        return True
+
+    # Snapshots keep the old shape, whole key -> details, so the other tree can answer queries for them
     def get_serialized(self):
         logger.info("Getting forest")
-        return json.dumps(self.forest)
+        return json.dumps({"seq": self.seq, "forest": {self.public_key(key_fingerprint): record.to_dict() for key_fingerprint, record in self.forest.items()}})
     
-    def from_serialized(self, json_dump):
-        if json_dump == "{}": # Its just empty
-            return
-        self.forest = json.loads(json_dump)
+    # Whether a leaf is still registered here or another tree still says it is there, `others` being the
+    # known_keys of every tree but the one the change came from
+    def held(self, key_fingerprint, others):
+        return key_fingerprint in self.transports or any(key_fingerprint in known_keys for known_keys in others)
+
+    # Merges a snapshot from another tree, anything that tree told us about before but has since dropped goes too
+    # Leaves registered here are never dropped or tracked because of another tree, a leaf that moved to it
+    # before this one noticed it leave is still here until its own connection goes. The same goes for a leaf
+    # that moved from one tree to another, it stays for as long as any tree says it is there
+    def from_serialized(self, json_dump, known_keys, others=()):
+        snapshot = json.loads(json_dump)
+        seen = {self.put(public_key, details) for public_key, details in snapshot["forest"].items()}
+        seen -= self.transports.keys()
+        for key_fingerprint in known_keys - seen:
+            if not self.held(key_fingerprint, others):
+                self.drop(key_fingerprint)
         logger.info("Updated forest")
+        return snapshot["seq"], seen
+
+    # These return the change so it can be sent on as a delta
+    def set(self, public_key, details, transport=None):
+        key_fingerprint = pubkeys.fingerprint(public_key)
+        op = "update" if key_fingerprint in self.forest else "add"
+        self.put(public_key, details, key_fingerprint)
+        if transport is not None:
+            self.index_transport(key_fingerprint, transport)
+        return {"op": op, "fingerprint": key_fingerprint.hex(), "key": public_key, "value": self.forest[key_fingerprint].to_dict()}
+
+    def remove(self, key_fingerprint):
+        self.drop(key_fingerprint)
+        return {"op": "remove", "fingerprint": key_fingerprint.hex()}
+
+    # Same as for snapshots, a remove only drops a leaf nothing else holds
+    def apply_changes(self, changes, known_keys, others=()):
+        for change in changes:
+            if change["op"] == "remove":
+                key_fingerprint = bytes.fromhex(change["fingerprint"])
+                known_keys.discard(key_fingerprint)
+                if not self.held(key_fingerprint, others):
+                    self.drop(key_fingerprint)
+            else:
+                key_fingerprint = self.put(change["key"], change["value"])
+                if key_fingerprint not in self.transports:
+                    known_keys.add(key_fingerprint)
+
+# Answers other trees gave us, least recently used goes first once it is full and nothing is trusted past `ttl` seconds
+class QueryCache:
+    def __init__(self, max_entries=10000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # fingerprint -> (expires at, [key, ip, port])
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key_fingerprint):
+        entry = self.entries.get(key_fingerprint)
+        if entry is None or entry[0] < reactor.seconds():
+            self.entries.pop(key_fingerprint, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key_fingerprint)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, found):
+        key_fingerprint = pubkeys.fingerprint(found[0])
+        self.entries[key_fingerprint] = (reactor.seconds() + self.ttl, found)
+        self.entries.move_to_end(key_fingerprint)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def discard(self, key_fingerprint):
+        self.entries.pop(key_fingerprint, None)
 
 # This really doesnt need to be here
 def to_mocking(text):
@@ -46,35 +186,186 @@ def to_mocking(text):
             result += char.upper()
     return result
 
-class ForestProtocol(Protocol):
+# Trees swap a full snapshot when they connect, after that only deltas of what changed go over
+# Each delta carries the senders sequence number, a gap means one went missing so a fresh snapshot gets asked for
+# Replication is one hop only: deltas are applied here and never passed on, so in a chain A - B - C (what joining
+# with -J builds) C only holds the leaves of A that were in B's snapshot when C joined. Anything C is missing is
+# found by forwarding the query to the trees it is joined to, see ForestFactory.route_query, which is what keeps
+# lookups working across more than one hop. Relaying would need a sequence number per tree the change started on
+# so copies coming round a loop of trees (--workers joins every worker to every other) could be told apart
+class ForestProtocol(framing.FramedProtocol):
+    MAX_LENGTH = 2**31 - 1 # The whole forest goes over in one frame
+
     def __init__(self, factory):
         self.factory = factory
+        self.last_seq = None # Last sequence number seen from the other tree, None until its snapshot arrives
+        self.known_keys = set() # Everything the other tree has told us about
         
     def connectionMade(self):
         self.factory.trees.append(self)
-        return self.transport.write(f"¬{forest.get_serialized()}".encode("utf-8"))
+        return self.sendMessage(forest.get_serialized())
     
     def connectionLost(self, reason = ...):
         self.factory.trees.remove(self) # Hopefully this'll remove the now defunct tree
         return super().connectionLost(reason)
     
-    def dataReceived(self, data):
-        decoded_data = data.decode("utf-8")
-        if decoded_data.startswith("¬"):
-            json_dump = decoded_data.removeprefix("¬")
-            forest.from_serialized(json_dump)
+    def frame_received(self, frame_type, payload):
+        if frame_type == framing.FOREST:
+            if not self.factory.replicate:
+                return
+            self.last_seq, self.known_keys = forest.from_serialized(payload.decode("utf-8"), self.known_keys, self.other_known_keys())
+        elif frame_type == framing.FOREST_DELTA:
+            delta = json.loads(payload)
+            for change in delta["changes"]: # Whatever left the other tree should not be answered from the cache either
+                if change["op"] == "remove":
+                    self.factory.cache.discard(bytes.fromhex(change["fingerprint"]))
+            if not self.factory.replicate:
+                return
+            if self.last_seq is None or delta["seq"] != self.last_seq + 1:
+                if self.last_seq is not None:
+                    logger.warning(f"Forest delta {delta['seq']} arrived after {self.last_seq}, asking for a snapshot")
+                    self.last_seq = None # Everything until the snapshot is ignored
+                    self.send_frame(framing.FOREST_SYNC, b"")
+                return
+            forest.apply_changes(delta["changes"], self.known_keys, self.other_known_keys())
+            self.last_seq = delta["seq"]
+        elif frame_type == framing.FOREST_SYNC:
+            self.sendMessage(forest.get_serialized())
+        elif frame_type == framing.FOREST_QUERY:
+            self.factory.query_received(self, json.loads(payload))
+        elif frame_type == framing.FOREST_ANSWER:
+            self.factory.answer_received(json.loads(payload))
             
+    def other_known_keys(self):
+        return [tree.known_keys for tree in self.factory.trees if tree is not self]
+
     def sendMessage(self, data):
-        self.transport.write(data.encode('utf-8'))
+        self.send_frame(framing.FOREST, data.encode('utf-8'))
+
+    def sendDelta(self, data):
+        self.send_frame(framing.FOREST_DELTA, data)
+
+    def sendAnswer(self, query_id, found):
+        self.send_frame(framing.FOREST_ANSWER, json.dumps({"id": query_id, "found": found}).encode('utf-8'))
 
 class ForestFactory(ReconnectingClientFactory):
-    def __init__(self):
+    FLUSH_CHANGES = 500 # Flush early once this many changes are waiting
+    FLUSH_BYTES = 256 * 1024 # ... or roughly this many bytes of them
+    QUERY_TTL = 4 # Trees a query can travel through past this one
+    HOP_TIMEOUT = 0.5 # Seconds given per hop left, so trees further out give up before the ones asking them
+    SEEN_QUERIES = 10000 # Query ids remembered so one going round a loop is only looked up once
+
+    def __init__(self, flush_window=0.05, replicate=True):
         self.trees = []
-    
-    def broadcast_change(self):
+        self.replicate = replicate # Without it other trees are only asked when a query misses here
+        self.cache = QueryCache()
+        self.seen_queries = OrderedDict()
+        self.waiting = {} # query id -> [deferred, timeout call, answers still to come]
+        self.flush_window = flush_window # Seconds changes are held for so a burst of registrations goes as one delta
+        self.pending = {} # Only the latest change per key is worth sending
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.flush_call = None
+        self.flush_stats = {"flushes": 0, "changes": 0, "bytes": 0, "latency": 0.0}
+
+    def queue_change(self, change):
+        if change["op"] == "remove":
+            self.cache.discard(bytes.fromhex(change["fingerprint"]))
+        if not self.pending:
+            self.pending_since = reactor.seconds()
+        self.pending[change["fingerprint"]] = change
+        self.pending_bytes += len(change.get("key", "")) + 128 # Close enough for deciding when to flush
+        if self.flush_window <= 0 or len(self.pending) >= self.FLUSH_CHANGES or self.pending_bytes >= self.FLUSH_BYTES:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = reactor.callLater(self.flush_window, self.flush)
+
+    def flush(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        if not self.pending:
+            return
+        changes = list(self.pending.values())
+        latency = reactor.seconds() - self.pending_since
+        self.pending = {}
+        self.pending_bytes = 0
+        sent = self.broadcast_change(changes)
+        self.flush_stats["flushes"] += 1
+        self.flush_stats["changes"] += len(changes)
+        self.flush_stats["bytes"] += sent
+        self.flush_stats["latency"] += latency
+        logger.info(f"Flushed {len(changes)} forest changes ({sent} bytes) to {len(self.trees)} trees after {latency * 1000:.1f}ms")
+
+    def broadcast_change(self, changes):
+        forest.seq += 1
+        delta = json.dumps({"seq": forest.seq, "changes": changes}).encode('utf-8')
         for tree in self.trees:
-            tree.sendMessage(f"¬{forest.get_serialized()}") # Much simple just to resend the entire dictionary
+            tree.sendDelta(delta)
+        return len(delta)
     
+    # [key, ip, port] from this tree or something another tree already answered, None otherwise
+    def resolve(self, query):
+        match = forest.lookup(query)
+        if match is not None:
+            public_key, record = match
+            return [public_key, record.ip, record.port]
+        return self.cache.get(pubkeys.query_fingerprint(query))
+
+    def remember_query(self, query_id):
+        self.seen_queries[query_id] = True
+        while len(self.seen_queries) > self.SEEN_QUERIES:
+            self.seen_queries.popitem(last=False)
+
+    # Asks every other tree, fires with the first [key, ip, port] any of them find or None once they all
+    # say no or the time runs out
+    def route_query(self, query, ttl=None, exclude=None, query_id=None):
+        ttl = self.QUERY_TTL if ttl is None else ttl
+        trees = [tree for tree in self.trees if tree is not exclude]
+        if ttl <= 0 or not trees:
+            return defer.succeed(None)
+        if query_id is None:
+            query_id = secrets.token_hex(8)
+            self.remember_query(query_id)
+        d = defer.Deferred()
+        timeout = reactor.callLater(self.HOP_TIMEOUT * ttl, self.finish_query, query_id, None)
+        self.waiting[query_id] = [d, timeout, len(trees)]
+        message = json.dumps({"id": query_id, "ttl": ttl - 1, "query": query}).encode('utf-8')
+        for tree in trees:
+            tree.send_frame(framing.FOREST_QUERY, message)
+        return d
+
+    def query_received(self, tree, message):
+        query_id = message["id"]
+        if query_id in self.seen_queries: # Came back round a loop, say no so the sender is not kept waiting
+            tree.sendAnswer(query_id, None)
+            return
+        self.remember_query(query_id)
+        found = self.resolve(message["query"])
+        if found is not None:
+            tree.sendAnswer(query_id, found)
+            return
+        d = self.route_query(message["query"], message["ttl"], exclude=tree, query_id=query_id)
+        d.addCallback(lambda found: tree.sendAnswer(query_id, found))
+
+    def answer_received(self, message):
+        waiting = self.waiting.get(message["id"])
+        if waiting is None: # Already answered or timed out
+            return
+        if message["found"] is not None:
+            self.cache.put(message["found"])
+            self.finish_query(message["id"], message["found"])
+            return
+        waiting[2] -= 1
+        if waiting[2] == 0:
+            self.finish_query(message["id"], None)
+
+    def finish_query(self, query_id, found):
+        d, timeout, _ = self.waiting.pop(query_id)
+        if timeout.active():
+            timeout.cancel()
+        d.callback(found)
+
     def buildProtocol(self, addr):
         return ForestProtocol(self)
     
@@ -82,24 +373,25 @@ class ForestFactory(ReconnectingClientFactory):
         logger.error(f"Connection lost in ForestFactory\n{connector}")
         logger.error("Need to implement reconnecting to leaf nodes below:")
         # Need to reconnect to each peer
-        for public_key, details in forest.forest.items():
+        for key_fingerprint, record in forest.forest.items():
             # reconnect stuff here
-            logger.error(f"  Public Key: {public_key}, IP: {details["ip"]}, Remote Port: {details["rport"]}")
+            logger.error(f"  Fingerprint: {key_fingerprint.hex()}, IP: {record.ip}, Remote Port: {record.rport}")
     
     def clientConnectionFailed(self, connector, reason):
         logger.error(f"Connection failed in ForestFactory\n{connector}")
 
-class UltrapeerProtocol(Protocol):
+REPLY_DELAY = 2 # Seconds the echo reply is held back for
+MAX_BATCH = 10000 # Most lookups answered from one batch query
+
+class UltrapeerProtocol(framing.FramedProtocol):
     def __init__(self, factory):
         self.factory = factory
 
     def remove_client_by_transport(self, transport):
         try:
-            for public_key, client_info in list(forest.forest.items()):
-                if client_info["transport"] is transport:
-                    logger.info(f"Removing client with public key: {public_key[88:108]}")
-                    del forest.forest[public_key]
-                    break
+            for key_fingerprint in list(forest.by_transport.get(transport, ())):
+                logger.info(f"Removing client with fingerprint: {key_fingerprint.hex()[:16]}")
+                forest_factory.queue_change(forest.remove(key_fingerprint))
         
         
         
@@ -113,36 +405,46 @@ class UltrapeerProtocol(Protocol):
         logger.info(f"Client disconnected. Reason: {reason.getErrorMessage()}")
         self.remove_client_by_transport(self.transport)
 
-    def dataSend(self, data):
-        try:
-            time.sleep(2)
-            self.transport.write(data.encode('utf-8'))
-        
-        
-        
-        except Exception as e:
-            logger.error(f"Error sending data: {e}")
+    # Replies that should go out later are scheduled on the reactor, sleeping here would freeze every connection
+    def dataSend(self, data, frame_type=framing.TEXT, delay=REPLY_DELAY):
+        d = task.deferLater(reactor, delay, self.send_frame, frame_type, data.encode('utf-8'))
+        d.addErrback(lambda failure: logger.error(f"Error sending data: {failure.getErrorMessage()}"))
+        return d
+
+    def query_answered(self, found, query):
+        if found is None:
+            logger.warning(f"Query for unknown public key: {query[88:108] or query[:16]} from {self.transport.getPeer().host}")
+            self.send_frame(framing.ERROR, f"{query}||¬Unknown".encode('utf-8'))
+            return
+        public_key, ip, port = found
+        self.send_frame(framing.RESPONSE, f"{public_key}||¬{ip}||¬{port}".encode('utf-8'))
+
+    def batch_answered(self, results, queries):
+        found = [result for result in results if result is not None]
+        unknown = [query for query, result in zip(queries, results) if result is None] + queries[MAX_BATCH:]
+        logger.info(f"Batch query for {len(queries)} keys from {self.transport.getPeer().host}, {len(found)} found")
+        self.send_frame(framing.RESPONSE_BATCH, json.dumps({"found": found, "unknown": unknown}).encode('utf-8'))
 
-    def dataReceived(self, data):
+    def frame_received(self, frame_type, payload):
         try:
-            decoded = data.decode('utf-8').strip()
+            decoded = payload.decode('utf-8').strip()
         except: # Data that cant be decoded this way is invalid
             return
         # Its a registration message so do not echo
-        if decoded.startswith("Registration¬|¬"):
+        if frame_type == framing.REGISTRATION:
             leaf = self.transport.getPeer()
-            parts = decoded.replace("Registration¬|¬", "").split("¬|¬")
+            parts = decoded.split("¬|¬")
             try:
                 public_key = parts[0]
                 port = parts[1]
-                forest.forest[public_key] = {
+                change = forest.set(public_key, {
                     "ip": leaf.host,
                     "port": port,
                     "rport": leaf.port
-                }
-                forest_factory.broadcast_change()
-                logger.info(f"Registered: {leaf.host}:{public_key[88:108]}")
-                self.transport.write(f"You are at {str(leaf.host)}".encode('utf-8'))
+                }, self.transport)
+                forest_factory.queue_change(change)
+                logger.info(f"Registered: {leaf.host}:{change['fingerprint'][:16]}")
+                self.send_frame(framing.TEXT, f"You are at {str(leaf.host)}".encode('utf-8'))
             
             
             
@@ -150,31 +452,49 @@ class UltrapeerProtocol(Protocol):
                 logger.error(f"Registration message format error from {leaf.host}: {decoded}")
             except Exception as e:
                 logger.error(f"Error processing registration from {leaf.host}: {e}")
-        elif decoded.startswith("Query¬¬|"):
-            # Its a query so do not echo
-            public_key = decoded.replace("Query¬¬|", "")
-            logger.info(f"Received query for {public_key[88:108]}")
+        elif frame_type == framing.QUERY:
+            # Its a query so do not echo, either the whole public key or the hex of its fingerprint
+            # Anything not known here is asked of the other trees before giving up on it
+            query = decoded
+            logger.info(f"Received query for {query[88:108] or query[:16]}")
             try:
-                response_ip = forest.forest[public_key]["ip"]
-                response_port = forest.forest[public_key]["port"]
-                self.transport.write(f"Response||¬{public_key}||¬{response_ip}||¬{response_port}".encode('utf-8'))
+                found = forest_factory.resolve(query)
+                if found is not None:
+                    self.query_answered(found, query)
+                else:
+                    forest_factory.route_query(query).addCallback(self.query_answered, query)
             
             
             
-            except KeyError:
-                logger.warning(f"Query for unknown public key: {public_key[88:108]} from {self.transport.getPeer().host}")
-                self.transport.write(f"Error||¬{public_key}||¬Unknown".encode('utf-8'))
             except Exception as e:
-                logger.error(f"Error processing query for {public_key[88:108]}: {e}")
+                logger.error(f"Error processing query for {query[88:108] or query[:16]}: {e}")
+        elif frame_type == framing.QUERY_BATCH:
+            # A whole address book in one go, everything found comes back in one frame
+            try:
+                queries = json.loads(decoded)
+                if not isinstance(queries, list):
+                    raise ValueError("batch query is not a list")
+                lookups = []
+                for query in queries[:MAX_BATCH]:
+                    found = forest_factory.resolve(str(query))
+                    lookups.append(defer.succeed(found) if found is not None else forest_factory.route_query(str(query)))
+                defer.gatherResults(lookups).addCallback(self.batch_answered, queries)
+            
+            
+            
+            except ValueError as e:
+                logger.error(f"Malformed batch query from {self.transport.getPeer().host}: {e}")
+                self.send_frame(framing.ERROR, f"Batch||¬{e}".encode('utf-8'))
         else:
-            logger.info(f"Received: {data.decode('utf-8')}")
+            logger.info(f"Received: {decoded}")
             self.dataSend(to_mocking(decoded))
 
 class UltrapeerFactory(Factory):
     def buildProtocol(self, addr):
         return UltrapeerProtocol(self)
 
-class SSLFactory(ssl.ContextFactory):
+# Shares one context across every listener and connection, see tlscontext
+class SSLFactory(tlscontext.SharedContextFactory):
     def __init__(self):
         # Generate certificate and key in memory
         key = crypto.PKey()
@@ -203,69 +523,123 @@ class SSLFactory(ssl.ContextFactory):
             logger.error(f"Error signing certificate: {e}")
             raise
 
-        self.private_key = key
-        self.certificate = cert
-
-    def getContext(self):
-        # Return cryptographic context
-        try:
-            ctx = ssl.SSL.Context(ssl.SSL.TLSv1_2_METHOD)
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore")
-                ctx.use_privatekey(self.private_key)
-                ctx.use_certificate(self.certificate)
-                ## Not behaving rn
-                # ctx.set_verify(
-                #     SSL.VERIFY_PEER | SSL.VERIFY_CLIENT_ONCE | SSL.VERIFY_FAIL_IF_NO_PEER_CERT
-                # )
-            return ctx
-        
-        
-        
-        except Exception as e:
-            logger.error(f"Error creating SSL context: {e}")
-            raise
+        super().__init__(key, cert)
     
-def main(ultrapeer, uport, join, port, fport, certificate):
+# listenSSL on a socket that is already listening, what each worker does with the ones run_workers made
+def listen(port, factory, context_factory, sock=None):
+    if sock is None:
+        return reactor.listenSSL(port, factory, context_factory)
+    listener = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, TLSMemoryBIOFactory(context_factory, False, factory))
+    sock.close() # The reactor has its own copy
+    return listener
+
+def listening_socket(port, interface="", reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+def worker(index, client_socket, forest_socket, siblings, ultrapeer, uport, join, port, fport, certificate, flush_window, replicate):
+    log_to(f"./logs/{socket.gethostname()}-{index}.log", force=True)
+    main(ultrapeer, uport, join, port, fport, certificate, flush_window, replicate, sockets=(client_socket, forest_socket), siblings=siblings)
+
+# One reactor per core. Every worker has its own socket on the client port with SO_REUSEPORT so the kernel
+# spreads leaves between them, and its own forest on fport + index. The workers join each others forests
+# like any other ultrapeer would so a leaf registered with one can be looked up through all of them
+def run_workers(ultrapeer, uport, join, port, fport, certificate, flush_window, replicate, workers):
+    context = multiprocessing.get_context("spawn") # Forked workers would all share the one epoll the parent's reactor made
+    # Everything is listening before any worker starts so none of them has to wait for another
+    sockets = [(listening_socket(port, reuse_port=True), listening_socket(fport + index, "" if index == 0 else "127.0.0.1")) for index in range(workers)]
+    processes = []
+    for index, (client_socket, forest_socket) in enumerate(sockets):
+        siblings = [fport + sibling for sibling in range(index)] # Each pair only needs joining once
+        process = context.Process(target=worker, name=f"ultrapeer-{index}", args=(index, client_socket, forest_socket, siblings,
+                                  ultrapeer, uport, join, port, fport + index, certificate, flush_window, replicate))
+        process.start()
+        processes.append(process)
+    for client_socket, forest_socket in sockets:
+        # A client socket left open here would still be handed its share of the leaves
+        client_socket.close()
+        forest_socket.close()
+    logger.info(f"Started {workers} workers on port {port}, forests on {fport}-{fport + workers - 1}")
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    for process in processes:
+        while True:
+            try:
+                process.join()
+                break
+            except KeyboardInterrupt: # Ctrl-C reaches the workers as well, they stop on their own
+                pass
+        logger.info(f"Worker {process.name} exited with {process.exitcode}")
+
+def main(ultrapeer, uport, join, port, fport, certificate, flush_window=0.05, replicate=True, workers=1, sockets=(None, None), siblings=()):
     global forest
     global forest_factory
     global ssl_factory
     global ultrapeer_factory
     
+    if workers > 1:
+        run_workers(ultrapeer, uport, join, port, fport, certificate, flush_window, replicate, workers)
+        return
     forest = Forest()
     
     try:
         logger.info("Starting secure server on port 9999...")
+        forest_factory = ForestFactory(flush_window, replicate)
+        ultrapeer_factory = UltrapeerFactory()
         if certificate == "":
-            ssl_factory = SSLFactory()
+            # Making the key takes a while, the reactor is already running by the time it is done
+            ready = threads.deferToThread(SSLFactory)
         else:
             try:
-                ssl_factory = cert_options = ssl.CertificateOptions(
+                ready = defer.succeed(ssl.CertificateOptions(
                     privateKey=(certificate+"cert.crt").encode('ascii'),
                     certificate=(certificate+"key.key").encode('ascii'),
                     verify=True # Genuinely it only needs verification if actual keys and certs are being used
-                )
+                ))
                 pass
             except:
                 print(f"Invalid SSL certificate directory {certificate}\nPlease make sure it contains both `cert.crt` and `key.key` and that they are a valid SSL certificate and key")
                 os._exit(1)
-        
-        forest_factory = ForestFactory()
-                
-        reactor.listenSSL(fport, forest_factory, ssl_factory) # Start listening on the forst protocol
-        if join:
-            try:
-                reactor.connectSSL(ultrapeer, uport, forest_factory, ssl_factory) # Try connect to the forest
-            except:
-                pass # It was not able to connect to the forest
-        ultrapeer_factory = UltrapeerFactory()
-        reactor.listenSSL(port, ultrapeer_factory, ssl_factory)
+        ready.addCallback(start_listening, ultrapeer, uport, join, port, fport, sockets, siblings)
+        ready.addErrback(failed_to_start)
+        watchdog.ReactorWatchdog(reactor).start()
         reactor.run()
     
     
     
     except Exception as e:
         logger.critical(f"Failed to start the server: {e}")
+
+# Everything that needs the TLS key, once it is there
+def start_listening(context_factory, ultrapeer, uport, join, port, fport, sockets, siblings):
+    global ssl_factory
+    ssl_factory = context_factory
+    client_socket, forest_socket = sockets
+    listen(fport, forest_factory, ssl_factory, forest_socket) # Start listening on the forst protocol
+    if join:
+        try:
+            reactor.connectSSL(ultrapeer, uport, forest_factory, tlscontext.client_creator(ssl_factory, ultrapeer, uport)) # Try connect to the forest
+        except:
+            pass # It was not able to connect to the forest
+    for sibling in siblings: # The other workers of this ultrapeer
+        reactor.connectSSL("127.0.0.1", sibling, forest_factory, tlscontext.client_creator(ssl_factory, "127.0.0.1", sibling))
+    listen(port, ultrapeer_factory, ssl_factory, client_socket)
+    tlscontext.log_on_shutdown(reactor, ssl_factory)
+    logger.info(f"Listening on port {port}, forest on {fport}")
+
+def failed_to_start(failure):
+    logger.critical(f"Failed to start the server: {failure.getErrorMessage()}")
+    reactor.callWhenRunning(reactor.stop) # The certificate given on the command line is checked before the reactor is up
         
 # Starts listning using SSL
 # Specifies Port, the factory (which makes the server node), and the cryptographic certs for SSL
@@ -279,13 +653,19 @@ if __name__ == "__main__":
     parser.add_argument("-UP", "--ultrapeer-port", dest="uport", type=int, default=4443,
                         help="Server port number (default: 4443)")
     parser.add_argument("-J", "--join", dest="join", default=False,
-                        help="Should the ultrapeer specified be joined (default: False)")
+                        help="Should the ultrapeer specified be joined, leaves are copied one hop and queries forwarded further (default: False)")
     parser.add_argument("-P", "--port", dest="port", type=int, default=9999,
                         help="Server port number (default: 9999)")
     parser.add_argument("-F", "--forest-port", dest="fport", type=int, default=4444,
                         help="Port number to use for syncing with the forst (default: 4444)")
     parser.add_argument("-C", "--certificate", dest="certificate", type=str, default="",
                         help="Directory containing certificate `cert.crt` and key `key.key`")
+    parser.add_argument("--forest-flush", dest="flush_window", type=float, default=0.05,
+                        help="Seconds to batch forest changes for before sending them to other ultrapeers, 0 sends each at once (default: 0.05)")
+    parser.add_argument("--no-replica", dest="replicate", action="store_false",
+                        help="Do not keep a copy of the other ultrapeers leaves, queries that miss here are forwarded to them instead")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Processes sharing the client port, each with its own forest on the ports after --forest-port (default: 1)")
     args = parser.parse_args()
     
     ultrapeer = args.ultrapeer
@@ -294,4 +674,7 @@ if __name__ == "__main__":
     port = args.port
     fport = args.fport
     certificate = args.certificate
-    main(ultrapeer, uport, join, port, fport, certificate)
\ No newline at end of file
+    flush_window = args.flush_window
+    replicate = args.replicate
+    workers = args.workers
+    main(ultrapeer, uport, join, port, fport, certificate, flush_window, replicate, workers)
\ No newline at end of file
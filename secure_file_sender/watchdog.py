@@ -0,0 +1,58 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# Flags anything that blocks the reactor thread. The reactor bumps a heartbeat every `interval`
+# and a separate thread watches it, if the heartbeat goes stale for longer than `threshold` the
+# reactor threads stack gets logged so whatever is blocking it shows up by name
+class ReactorWatchdog:
+    def __init__(self, reactor, interval=0.05, threshold=0.25):
+        self.reactor = reactor
+        self.interval = interval
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.reactor_thread = None
+        self.stalls = 0
+        self.worst_stall = 0.0
+        self.loop = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self.loop = task.LoopingCall(self.beat)
+        self.loop.clock = self.reactor
+        self.loop.start(self.interval)
+        threading.Thread(target=self.watch, name="ReactorWatchdog", daemon=True).start()
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def beat(self):
+        now = time.monotonic()
+        self.reactor_thread = threading.get_ident()
+        stalled = now - self.last_beat - self.interval
+        if stalled > self.threshold:
+            self.stalls += 1
+            self.worst_stall = max(self.worst_stall, stalled)
+            logger.warning(f"Reactor thread was blocked for {stalled * 1000:.0f}ms")
+        self.last_beat = now
+
+    def watch(self):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self.last_beat
+            if self.reactor_thread is None or beat == reported:
+                continue
+            if time.monotonic() - beat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.reactor_thread)
+                if frame is not None:
+                    stack = "".join(traceback.format_stack(frame))
+                    logger.warning(f"Blocking call on the reactor thread:\n{stack}")
+                reported = beat # Once per stall is plenty